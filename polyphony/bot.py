@@ -5,7 +5,10 @@ import sqlite3
 import discord
 from discord.ext import commands
 
-from .helpers.database import init_db
+from .helpers.database import close_db, init_db
+from .helpers import profile_edits
+from .helpers.emote_cache import persistent_emotes
+from .helpers.http import close_session
 from .helpers.log_message import LogMessage
 from .instance.helper import HelperInstance
 from .settings import (
@@ -16,9 +19,17 @@ from .settings import (
 
 log = logging.getLogger(__name__)
 
+
+class PolyphonyBot(commands.Bot):
+    async def close(self):
+        await super().close()
+        # Close the shared HTTP session while the event loop is still running
+        await close_session()
+
+
 # Main Polyhony Bot Instance
 intents = discord.Intents.all()
-bot = commands.Bot(command_prefix=COMMAND_PREFIX, intents=intents)
+bot = PolyphonyBot(command_prefix=COMMAND_PREFIX, intents=intents)
 helper = HelperInstance(intents=intents)
 
 # Disable default help
@@ -69,15 +80,21 @@ async def on_ready():
         helper_thread.thread = asyncio.run_coroutine_threadsafe(helper.start(TOKEN), bot.loop)
         helper_thread.running = True
 
+    # Apply profile edits that were waiting for rate limit budget
+    profile_edits.start()
+
     # Emote cache cleanup
-    log.debug("Cleaning emote cache emotes...")
+    log.debug("Reconciling emote cache...")
     guild = bot.get_guild(GUILD_ID)
     if guild:
-        for emote in guild.emojis:
-            emote = await guild.fetch_emoji(emote.id)
-            if emote.user.id == bot.user.id:
-                await emote.delete()
-    log.debug("Emote cache emote cleaning complete")
+        await persistent_emotes.reconcile(guild, bot.user.id)
+    log.debug("Emote cache reconciled")
+
+
+@bot.event
+async def on_guild_emojis_update(guild: discord.Guild, before, after):
+    if guild.id == GUILD_ID:
+        persistent_emotes.emojis_updated(before, after)
 
 
 @bot.command()
@@ -128,3 +145,4 @@ async def reload(ctx: commands.context):
 
 
 bot.run(TOKEN)
+close_db()
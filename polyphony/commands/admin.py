@@ -13,15 +13,27 @@ from disputils import BotConfirmation
 from polyphony.helpers.checks import is_mod, check_token
 from polyphony.helpers.database import (
     insert_member,
-    c,
-    conn,
+    get_member,
+    get_member_by_pk_id,
+    get_members,
+    get_system,
+    get_tag_conflicts,
+    get_token,
+    get_tokens,
+    get_user,
+    insert_token,
+    insert_user,
+    update_member,
+    update_sync_state,
+    delete_member,
 )
 from polyphony.helpers.decode_token import decode_token
 from polyphony.helpers.log_message import LogMessage
 from polyphony.helpers.member_list import send_member_list
 from polyphony.helpers.pluralkit import pk_get_member
 from polyphony.helpers.reset import reset
-from polyphony.helpers.sync import sync
+from polyphony.helpers.sync import default_roles_state, sync
+from polyphony.helpers.token_inventory import token_inventory
 from polyphony.instance.bot import PolyphonyInstance
 from polyphony.settings import (
     DEFAULT_INSTANCE_PERMS,
@@ -56,8 +68,7 @@ class Admin(commands.Cog):
         if ctx.invoked_subcommand is not None:
             return
         log.debug("Listing active members...")
-        c.execute("SELECT * FROM members WHERE member_enabled == 1")
-        member_list = c.fetchall()
+        member_list = get_members(enabled=True)
         embed = discord.Embed(title="Active Members")
         await send_member_list(ctx, embed, member_list)
 
@@ -65,8 +76,7 @@ class Admin(commands.Cog):
     @commands.check_any(commands.is_owner(), is_mod())
     async def all(self, ctx: commands.context):
         log.debug("Listing all members...")
-        c.execute("SELECT * FROM members")
-        member_list = c.fetchall()
+        member_list = get_members()
         embed = discord.Embed(title="All Members")
         await send_member_list(ctx, embed, member_list)
 
@@ -74,11 +84,7 @@ class Admin(commands.Cog):
     @commands.check_any(commands.is_owner(), is_mod())
     async def _system(self, ctx: commands.context, member: discord.Member):
         log.debug(f"Listing members for {member.display_name}...")
-        c.execute(
-            "SELECT * FROM members WHERE main_account_id == ?",
-            [member.id],
-        )
-        member_list = c.fetchall()
+        member_list = get_system(member.id)
         embed = discord.Embed(title=f"Members of System")
         embed.set_author(name=f"{member} ({member.id})", icon_url=member.avatar_url)
         await send_member_list(ctx, embed, member_list)
@@ -87,8 +93,7 @@ class Admin(commands.Cog):
     @commands.check_any(commands.is_owner(), is_mod())
     async def suspended(self, ctx: commands.context):
         log.debug("Listing suspended members...")
-        c.execute("SELECT * FROM members WHERE member_enabled == 0")
-        member_list = c.fetchall()
+        member_list = get_members(enabled=False)
         embed = discord.Embed(title="Suspended Members")
         await send_member_list(ctx, embed, member_list)
 
@@ -113,206 +118,227 @@ class Admin(commands.Cog):
         logger = LogMessage(ctx, title="Registering...")
         await logger.init()
 
-        async with ctx.channel.typing():
-            # Error: Account is not a user
-            if account.bot is True:
-                await logger.set(
-                    title="Error Registering: Bad Account Pairing",
-                    color=discord.Color.red(),
-                )
-                await logger.log(f"{account.mention} is a bot user")
-                return
+        reservation = None
+        try:
+            async with ctx.channel.typing():
+                # Error: Account is not a user
+                if account.bot is True:
+                    await logger.set(
+                        title="Error Registering: Bad Account Pairing",
+                        color=discord.Color.red(),
+                    )
+                    await logger.log(f"{account.mention} is a bot user")
+                    return
 
-            # Get available tokens
-            token = conn.execute("SELECT * FROM tokens WHERE used == 0").fetchone()
+                # Reserve a token so concurrent registrations can't take the same one
+                reservation = token_inventory.reserve()
 
-            # Error: No Slots Available
-            if not token:
-                await logger.set(
-                    title=":x: Error Registering: No Slots Available",
-                    color=discord.Color.red(),
-                )
-                await logger.log(
-                    f":x: No tokens in queue. Run `{self.bot.command_prefix}tokens` for information on how to add more."
-                )
-                return
-
-            # Error: Duplicate Registration
-            check_duplicate = conn.execute(
-                "SELECT * FROM members WHERE pk_member_id == ?",
-                [pluralkit_member_id],
-            ).fetchone()
-            if check_duplicate:
-                await logger.set(
-                    title=":x: Error Registering: Member Already Registered",
-                    color=discord.Color.red(),
-                )
-                await logger.log(
-                    f":x: Member ID `{pluralkit_member_id}` is already registered with instance {self.bot.get_user(check_duplicate['id'])}"
-                )
-                return
+                # Error: No Slots Available
+                if reservation is None:
+                    await logger.set(
+                        title=":x: Error Registering: No Slots Available",
+                        color=discord.Color.red(),
+                    )
+                    await logger.log(
+                        f":x: No tokens in queue. Run `{self.bot.command_prefix}tokens` for information on how to add more."
+                    )
+                    return
+
+                # Error: Duplicate Registration
+                check_duplicate = get_member_by_pk_id(pluralkit_member_id)
+                if check_duplicate:
+                    await logger.set(
+                        title=":x: Error Registering: Member Already Registered",
+                        color=discord.Color.red(),
+                    )
+                    await logger.log(
+                        f":x: Member ID `{pluralkit_member_id}` is already registered with instance {self.bot.get_user(check_duplicate['id'])}"
+                    )
+                    return
 
-            # Fetch member from PluralKit
-            await logger.log(":hourglass: Fetching member from PluralKit...")
-            member = await pk_get_member(pluralkit_member_id)
+                # Fetch member from PluralKit
+                await logger.log(":hourglass: Fetching member from PluralKit...")
+                member = await pk_get_member(pluralkit_member_id)
 
-            # Error: Member not found
-            if member is None:
-                await logger.set(
-                    title=":x: Error Registering: Member ID invalid",
-                    color=discord.Color.red(),
-                )
-                await logger.log(f":x: Member ID `{pluralkit_member_id}` was not found")
-                return
-
-            # Error: Missing PluralKit Data
-            if (
-                member["name"] is None
-                or member["avatar_url"] is None
-                or member["proxy_tags"] is None
-            ):
-                await logger.set(
-                    title=":x: Error Registering: Missing PluralKit Data",
-                    color=discord.Color.red(),
-                )
-                if member["name"] is None:
-                    await logger.log(":warning: Member is missing a name")
-                if member["avatar_url"] is None:
-                    await logger.log(":warning: Member is missing an avatar")
-                if member["proxy_tags"] is None:
-                    await logger.log(":warning: Member is missing proxy tags")
-                await logger.log(
-                    "\n:x: *Please check the privacy settings on PluralKit*"
-                )
-                return
+                # Error: Member not found
+                if member is None:
+                    await logger.set(
+                        title=":x: Error Registering: Member ID invalid",
+                        color=discord.Color.red(),
+                    )
+                    await logger.log(f":x: Member ID `{pluralkit_member_id}` was not found")
+                    return
 
-            system_name = f"__**{member['name']}**__ (`{member['id']}`)"
-            await logger.edit(
-                -1,
-                f":white_check_mark: Fetched member __**{member['name']}**__ (`{member['id']}`)",
-            )
+                # Error: Missing PluralKit Data
+                if (
+                    member["name"] is None
+                    or member["avatar_url"] is None
+                    or member["proxy_tags"] is None
+                ):
+                    await logger.set(
+                        title=":x: Error Registering: Missing PluralKit Data",
+                        color=discord.Color.red(),
+                    )
+                    if member["name"] is None:
+                        await logger.log(":warning: Member is missing a name")
+                    if member["avatar_url"] is None:
+                        await logger.log(":warning: Member is missing an avatar")
+                    if member["proxy_tags"] is None:
+                        await logger.log(":warning: Member is missing proxy tags")
+                    await logger.log(
+                        "\n:x: *Please check the privacy settings on PluralKit*"
+                    )
+                    return
 
-            # Confirm add
-            confirmation = BotConfirmation(ctx, discord.Color.blue())
-            await confirmation.confirm(
-                f":grey_question: Create member for {account} with member {system_name}?"
-            )
-            if confirmation.confirmed:
-                await confirmation.message.delete()
-            else:
-                await confirmation.message.delete()
-                await logger.set(
-                    title=":x: Registration Cancelled", color=discord.Color.red()
-                )
-                await logger.log(":x: Registration cancelled by user")
-                return
-
-            # Check if user is new to Polyphony
-            if (
-                conn.execute(
-                    "SELECT * FROM users WHERE id = ?", [account.id]
-                ).fetchone()
-                is None
-            ):
-                await logger.log(
-                    f":tada: {account.mention} is a new user! Registering them with Polyphony"
-                )
-                conn.execute("INSERT INTO users VALUES (?, NULL, NULL)", [account.id])
-                conn.commit()
-
-            # Insert member into database
-            await logger.log(":hourglass: Adding to database...")
-            try:
-                insert_member(
-                    token["token"],
-                    member["id"],
-                    account.id,
-                    decode_token(token["token"]),
-                    member["name"],
-                    member["display_name"],
-                    member["avatar_url"],
-                    member["proxy_tags"],
-                    member["keep_proxy"],
-                    member_enabled=True,
+                system_name = f"__**{member['name']}**__ (`{member['id']}`)"
+                await logger.edit(
+                    -1,
+                    f":white_check_mark: Fetched member __**{member['name']}**__ (`{member['id']}`)",
                 )
-                await logger.edit(-1, ":white_check_mark: Added to database")
 
-            # Error: Database Error
-            except sqlite3.Error as e:
-                log.error(e)
-                await logger.set(
-                    title=":x: Error Registering: Database Error",
-                    color=discord.Color.red(),
+                # Confirm add
+                confirmation = BotConfirmation(ctx, discord.Color.blue())
+                await confirmation.confirm(
+                    f":grey_question: Create member for {account} with member {system_name}?"
                 )
-                await logger.edit(-1, ":x: An unknown database error occurred")
-                return
+                if confirmation.confirmed:
+                    await confirmation.message.delete()
+                else:
+                    await confirmation.message.delete()
+                    await logger.set(
+                        title=":x: Registration Cancelled", color=discord.Color.red()
+                    )
+                    await logger.log(":x: Registration cancelled by user")
+                    return
 
-            # Mark token as used
-            conn.execute(
-                "UPDATE tokens SET used = 1 WHERE token = ?",
-                [token["token"]],
-            )
-            conn.commit()
+                # Check if user is new to Polyphony
+                if get_user(account.id) is None:
+                    await logger.log(
+                        f":tada: {account.mention} is a new user! Registering them with Polyphony"
+                    )
+                    insert_user(account.id)
+
+                # Error: Reservation Expired
+                # The token can't be handed out again from here on, since the member is about to use it
+                reservation.hold()
+                if not reservation.active:
+                    await logger.set(
+                        title=":x: Error Registering: Timed Out",
+                        color=discord.Color.red(),
+                    )
+                    await logger.log(":x: Registration took too long, please try again")
+                    return
 
-            # Create Instance
-            await logger.log(":hourglass: Syncing Instance...")
-            instance = PolyphonyInstance(pluralkit_member_id)
-            asyncio.run_coroutine_threadsafe(
-                instance.start(token["token"]), self.bot.loop
-            )
-            await instance.wait_until_ready()
-
-            sync_error_text = ""
-
-            # Update Username
-            await logger.edit(-1, f":hourglass: Syncing Username...")
-            out = await instance.update_username(member["name"])
-            if out != 0:
-                sync_error_text += f"> {out}\n"
-
-            # Update Avatar URL
-            await logger.edit(-1, f":hourglass: Syncing Avatar...")
-            out = await instance.update_avatar(member["avatar_url"])
-            if out != 0:
-                sync_error_text += f"> {out}\n"
-
-            # Update Nickname
-            await logger.edit(-1, f":hourglass: Syncing Nickname...")
-            out = await instance.update_nickname(member["display_name"])
-            if out < 0:
-                sync_error_text += f"> PluralKit display name must be 32 or fewer in length if you want to use it as a nickname"
-            elif out > 0:
-                sync_error_text += f"> Nick didn't update on {out} guild(s)\n"
-
-            # Update Roles
-            await logger.edit(-1, f":hourglass: Updating Roles...")
-            out = await instance.update_default_roles()
-            if out:
-                sync_error_text += f"> {out}\n"
-
-            if sync_error_text == "":
-                await logger.edit(-1, ":white_check_mark: Synced instance")
-            else:
-                await logger.edit(-1, ":warning: Synced instance with errors:")
-                await logger.log(sync_error_text)
+                # Insert member into database
+                await logger.log(":hourglass: Adding to database...")
+                try:
+                    await insert_member(
+                        reservation.token,
+                        member["id"],
+                        account.id,
+                        decode_token(reservation.token),
+                        member["name"],
+                        member["display_name"],
+                        member["avatar_url"],
+                        member["proxy_tags"],
+                        member["keep_proxy"],
+                        member_enabled=True,
+                    )
+                    await logger.edit(-1, ":white_check_mark: Added to database")
+
+                # Error: Database Error
+                except sqlite3.Error as e:
+                    log.error(e)
+                    await logger.set(
+                        title=":x: Error Registering: Database Error",
+                        color=discord.Color.red(),
+                    )
+                    await logger.edit(-1, ":x: An unknown database error occurred")
+                    return
+
+                # Mark token as used
+                reservation.commit()
+
+                # Create Instance
+                await logger.log(":hourglass: Syncing Instance...")
+                instance = PolyphonyInstance(pluralkit_member_id)
+                await instance.login_rest(reservation.token)
+
+                sync_error_text = ""
+                applied = {}  # Recorded like a sync so the first sync skips what is already applied
+
+                # Update Username
+                await logger.edit(-1, f":hourglass: Syncing Username...")
+                out = await instance.update_username(member["name"])
+                if out != 0:
+                    sync_error_text += f"> {out}\n"
+                if instance.username_applied(member["name"]):
+                    applied["username"] = member["name"]
+
+                # Update Avatar URL
+                await logger.edit(-1, f":hourglass: Syncing Avatar...")
+                out = await instance.update_avatar(member["avatar_url"])
+                if out != 0:
+                    sync_error_text += f"> {out}\n"
+                else:
+                    applied["avatar_url"] = member["avatar_url"]
+                    applied["avatar_digest"] = instance.avatar_digest
+
+                # Update Nickname
+                await logger.edit(-1, f":hourglass: Syncing Nickname...")
+                out = await instance.update_nickname(member["display_name"])
+                if out < 0:
+                    sync_error_text += f"> PluralKit display name must be 32 or fewer in length if you want to use it as a nickname"
+                elif out > 0:
+                    sync_error_text += f"> Nick didn't update on {out} guild(s)\n"
+                else:
+                    applied["nickname"] = member["display_name"]
 
-        # Success State
-        logger.content = []
-        await logger.set(
-            title=f":white_check_mark: Registered __{member['name']}__",
-            color=discord.Color.green(),
-        )
+                # Update Roles
+                await logger.edit(-1, f":hourglass: Updating Roles...")
+                out = await instance.update_default_roles()
+                if out:
+                    sync_error_text += f"> {out}\n"
+                else:
+                    applied["roles"] = default_roles_state()
 
-        slots = conn.execute("SELECT * FROM tokens WHERE used = 0").fetchall()
-        await logger.log(f":arrow_forward: **User is {instance.user.mention}**")
-        if sync_error_text != "":
-            await logger.log(":warning: Synced instance with errors:")
-            await logger.log(sync_error_text)
-        await logger.log(f"*There are now {len(slots)} slots available*")
-        log.info(
-            f"{instance.user} ({instance.pk_member_id}): New member instance registered ({len(slots)} slots left)"
-        )
-        await instance.close()
+                if applied:
+                    update_sync_state(decode_token(reservation.token), **applied)
+
+                if sync_error_text == "":
+                    await logger.edit(-1, ":white_check_mark: Synced instance")
+                else:
+                    await logger.edit(-1, ":warning: Synced instance with errors:")
+                    await logger.log(sync_error_text)
+
+            # Success State
+            logger.content = []
+            await logger.set(
+                title=f":white_check_mark: Registered __{member['name']}__",
+                color=discord.Color.green(),
+            )
+
+            slots = token_inventory.available
+            await logger.log(f":arrow_forward: **User is {instance.user.mention}**")
+            if sync_error_text != "":
+                await logger.log(":warning: Synced instance with errors:")
+                await logger.log(sync_error_text)
+            for conflict in await get_tag_conflicts(account.id):
+                if instance.user.id not in (conflict["member_id"], conflict["other_id"]):
+                    continue
+                other_id = conflict["other_id"] if conflict["member_id"] == instance.user.id else conflict["member_id"]
+                await logger.log(
+                    f":warning: Tag `{conflict['prefix']}text{conflict['suffix']}` is also used by <@{other_id}>"
+                )
+            await logger.log(f"*There are now {slots} slots available*")
+            log.info(
+                f"{instance.user} ({instance.pk_member_id}): New member instance registered ({slots} slots left)"
+            )
+            await instance.close()
+        finally:
+            # Gives the token back unless the registration committed it
+            if reservation is not None:
+                reservation.release()
 
     @commands.group()
     @commands.check_any(commands.is_owner(), is_mod())
@@ -321,7 +347,7 @@ class Admin(commands.Cog):
             return
         await sync(
             ctx,
-            conn.execute("SELECT * FROM members WHERE member_enabled = 1").fetchall(),
+            get_members(enabled=True),
         )
 
     @syncall.command()
@@ -335,9 +361,7 @@ class Admin(commands.Cog):
         """
         await sync(
             ctx,
-            conn.execute(
-                "SELECT * FROM members WHERE main_account_id = ?", [main_user.id]
-            ).fetchall(),
+            get_system(main_user.id),
         )
 
     @syncall.command()
@@ -351,9 +375,7 @@ class Admin(commands.Cog):
         """
         await sync(
             ctx,
-            conn.execute(
-                "SELECT * FROM members WHERE id = ?", [system_member.id]
-            ).fetchall(),
+            [m for m in [get_member(system_member.id)] if m is not None],
         )
 
     @commands.command()
@@ -389,10 +411,7 @@ class Admin(commands.Cog):
         :param system_member: System Member
         """
         await ctx.message.delete()
-        member = conn.execute(
-            "SELECT * FROM members WHERE id = ?",
-            [system_member.id],
-        ).fetchone()
+        member = get_member(system_member.id)
         if member is not None:
             if member["member_enabled"] == 0:
                 await ctx.send(
@@ -403,11 +422,7 @@ class Admin(commands.Cog):
                     delete_after=10,
                 )
             else:
-                conn.execute(
-                    "UPDATE members SET member_enabled = 0 WHERE id = ?",
-                    [system_member.id],
-                )
-                conn.commit()
+                update_member(system_member.id, member_enabled=0)
                 await ctx.send(
                     embed=discord.Embed(
                         description=f":white_check_mark: {system_member.mention} suspended by {ctx.author.mention}",
@@ -434,10 +449,7 @@ class Admin(commands.Cog):
         :param system_member: System Member
         """
         await ctx.message.delete()
-        member = conn.execute(
-            "SELECT * FROM members WHERE id = ?",
-            [system_member.id],
-        ).fetchone()
+        member = get_member(system_member.id)
         if member is not None:
             if member["member_enabled"] == 1:
                 await ctx.send(
@@ -448,11 +460,7 @@ class Admin(commands.Cog):
                     delete_after=10,
                 )
             else:
-                conn.execute(
-                    "UPDATE members SET member_enabled = 1 WHERE id = ?",
-                    [system_member.id],
-                )
-                conn.commit()
+                update_member(system_member.id, member_enabled=1)
                 await ctx.send(
                     embed=discord.Embed(
                         description=f":white_check_mark: {system_member.mention} enabled by {ctx.author.mention}",
@@ -479,10 +487,7 @@ class Admin(commands.Cog):
         :param system_member: System Member
         """
         await ctx.message.delete()
-        member = conn.execute(
-            "SELECT * FROM members WHERE id = ?",
-            [system_member.id],
-        ).fetchone()
+        member = get_member(system_member.id)
         if member is not None:
             log.debug(f"Disabling {system_member}")
             confirmation = BotConfirmation(ctx, discord.Color.red())
@@ -491,11 +496,7 @@ class Admin(commands.Cog):
             )
             if confirmation.confirmed:
                 await confirmation.message.delete()
-                conn.execute(
-                    "DELETE FROM members WHERE id = ?",
-                    [system_member.id],
-                )
-                conn.commit()
+                delete_member(system_member.id)
                 await ctx.send(
                     embed=discord.Embed(
                         description=f":ballot_box_with_check: {system_member.mention} **permanently disabled** by {ctx.author.mention}",
@@ -548,7 +549,7 @@ class Admin(commands.Cog):
                 await logger.init()
                 # Check token
                 await logger.log(f"Checking token #{index+1}...")
-                all_tokens = conn.execute("SELECT * FROM tokens").fetchall()
+                all_tokens = get_tokens()
                 chk = False
                 token_client = decode_token(token)
                 for chk_token in all_tokens:
@@ -565,25 +566,18 @@ class Admin(commands.Cog):
                     await logger.log("Bot token is invalid")
                 else:
                     await logger.log("Token valid")
-                    if (
-                        conn.execute(
-                            "SELECT * FROM tokens WHERE token = ?", [token]
-                        ).fetchone()
-                        is None
-                    ):
-                        conn.execute("INSERT INTO tokens VALUES(?, ?)", [token, False])
-                        conn.commit()
+                    if get_token(token) is None:
+                        insert_token(token, False)
                         logger.title = f"Bot token #{index+1} added"
                         logger.color = discord.Color.green()
-                        c.execute("SELECT * FROM tokens WHERE used = 0")
-                        slots = c.fetchall()
+                        slots = token_inventory.available
                         from polyphony.bot import bot
 
                         await logger.send(
-                            f"[Invite to Server]({discord.utils.oauth_url(client_id, permissions=discord.Permissions(DEFAULT_INSTANCE_PERMS), guild=bot.get_guild(GUILD_ID))})\n\n**Client ID:** {client_id}\nThere are now {len(slots)} slot(s) available"
+                            f"[Invite to Server]({discord.utils.oauth_url(client_id, permissions=discord.Permissions(DEFAULT_INSTANCE_PERMS), guild=bot.get_guild(GUILD_ID))})\n\n**Client ID:** {client_id}\nThere are now {slots} slot(s) available"
                         )
                         log.info(
-                            f"New token added by {ctx.author} (There are now {len(slots)} slots)"
+                            f"New token added by {ctx.author} (There are now {slots} slots)"
                         )
                     else:
                         logger.title = f"Token #{index+1} already in database"
@@ -649,18 +643,9 @@ class Admin(commands.Cog):
 
             if decode_token(token) == member.id:
                 await logger.log("Token valid")
-                if (
-                        conn.execute(
-                            "SELECT * FROM tokens WHERE token = ?", [token]
-                        ).fetchone()
-                        is None
-                ):
-                    conn.execute("INSERT INTO tokens VALUES(?, ?)", [token, True])
-                    conn.execute(
-                        "UPDATE members SET token = ? WHERE id = ?",
-                        [token, member.id],
-                    )
-                    conn.commit()
+                if get_token(token) is None:
+                    insert_token(token, True)
+                    update_member(member.id, token=token)
                     logger.title = f"Token updated"
                     logger.color = discord.Color.green()
 
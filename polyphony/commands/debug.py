@@ -1,7 +1,6 @@
 """
 Admin commands to configure polyphony
 """
-import asyncio
 import logging
 import pprint
 import random
@@ -10,15 +9,28 @@ import discord
 from discord.ext import commands
 
 from polyphony.helpers.checks import is_mod
-from polyphony.helpers.database import conn
+from polyphony.helpers.database import (
+    check_query_plans,
+    delete_member,
+    delete_user,
+    get_member,
+    get_members,
+    get_user,
+    insert_user,
+    update_member,
+    update_token,
+)
 from polyphony.helpers.decode_token import decode_token
+from polyphony.helpers import log_message
 from polyphony.helpers.log_message import LogMessage
 from polyphony.helpers.pluralkit import (
     pk_get_system,
     pk_get_system_members,
     pk_get_member,
+    pk_cache_stats,
 )
 from polyphony.helpers.reset import reset
+from polyphony.helpers.token_inventory import token_inventory
 from polyphony.instance.bot import PolyphonyInstance
 
 log = logging.getLogger("polyphony." + __name__)
@@ -31,21 +43,21 @@ class Debug(commands.Cog):
     @commands.command()
     @commands.check_any(commands.is_owner(), is_mod())
     async def getsystem(self, ctx: commands.context, system):
-        system_out = pprint.pformat(await pk_get_system(system))
+        system_out = pprint.pformat(await pk_get_system(system, max_age=0))
         log.debug(f"\n{system_out}")
         await ctx.send(f"```python\n{system_out}```")
 
     @commands.command()
     @commands.check_any(commands.is_owner(), is_mod())
     async def getsystemmembers(self, ctx: commands.context, system):
-        system_out = pprint.pformat(await pk_get_system_members(system))
+        system_out = pprint.pformat(await pk_get_system_members(system, max_age=0))
         log.debug(f"\n{system_out}")
         await ctx.send(f"```python\n{system_out}```")
 
     @commands.command()
     @commands.check_any(commands.is_owner(), is_mod())
     async def getmember(self, ctx: commands.context, member):
-        member_out = pprint.pformat(await pk_get_member(member))
+        member_out = pprint.pformat(await pk_get_member(member, max_age=0))
         log.debug(f"\n{member_out}")
         await ctx.send(f"```python\n{member_out}```")
 
@@ -77,18 +89,13 @@ class Debug(commands.Cog):
     @commands.is_owner()
     async def deregister(self, ctx: commands.context, ctx_member: discord.Member):
         # TODO: Option to delete all old messages
-        member = conn.execute(
-            "SELECT * FROM members WHERE id = ?", [ctx_member.id]
-        ).fetchone()
+        member = get_member(ctx_member.id)
         if member:
             logger = LogMessage(ctx, title="Deregistering...")
             await logger.init()
             with ctx.channel.typing():
                 instance = PolyphonyInstance(member["pk_member_id"])
-                asyncio.run_coroutine_threadsafe(
-                    instance.start(member["token"]), self.bot.loop
-                )
-                await instance.wait_until_ready()
+                await instance.login_rest(member["token"])
 
                 await logger.log("Updating Random Username...")
                 await instance.update_username(f"{random.randint(0000, 9999)}")
@@ -108,20 +115,13 @@ class Debug(commands.Cog):
                 await instance.update_default_roles()  # TODO: Catch errors
 
                 await logger.log("Freeing Token...")
-                conn.execute(
-                    "UPDATE tokens SET used = 0 WHERE token = ?",
-                    [member["token"]],
-                )
+                update_token(member["token"], False)
                 await logger.log("Updating Database...")
-                conn.execute(
-                    "DELETE FROM members WHERE token = ?",
-                    [member["token"]],
-                )
-                conn.commit()
+                delete_member(member["id"])
 
                 await instance.close()
 
-                await logger.message.delete()
+                await logger.delete()
                 await ctx.channel.send(
                     f"`POLYPHONY SYSTEM UTILITIES` {ctx_member.mention} has been deregistered and the token has been made available"
                 )
@@ -133,11 +133,7 @@ class Debug(commands.Cog):
     @commands.command()
     @commands.is_owner()
     async def removeuser(self, ctx: commands.context, member: discord.Member):
-        conn.execute(
-            "DELETE FROM users WHERE id = ?",
-            [member.id],
-        )
-        conn.commit()
+        delete_user(member.id)
         await ctx.channel.send(
             f"`POLYPHONY SYSTEM UTILITIES` {member.mention} has been removed from the collection of Polyphony users."
         )
@@ -150,40 +146,25 @@ class Debug(commands.Cog):
         instance: discord.Member,
         main_account: discord.Member,
     ):
-        if (
-            conn.execute("SELECT * FROM members WHERE id = ?", [instance.id]).fetchone()
-            is None
-        ):
+        if get_member(instance.id) is None:
             await ctx.channel.send(
                 f"`POLYPHONY SYSTEM UTILITIES` {instance.mention} is not a Polyphony instance"
             )
             return
-        if (
-            conn.execute(
-                "SELECT * FROM users WHERE id = ?", [main_account.id]
-            ).fetchone()
-            is None
-        ):
-            conn.execute("INSERT INTO users VALUES (?, NULL, NULL)", [main_account.id])
+        if get_user(main_account.id) is None:
+            insert_user(main_account.id)
             await ctx.send(
                 f"`POLYPHONY SYSTEM UTILITIES` {main_account.mention} is a new Polyphony user. Adding to database..."
             )
-        conn.execute(
-            "UPDATE members SET main_account_id = ? WHERE id = ?",
-            [main_account.id, instance.id],
-        )
+        update_member(instance.id, main_account_id=main_account.id)
         await ctx.send(
             f"`POLYPHONY SYSTEM UTILITIES` {instance.mention} is now assigned to {main_account.mention}"
         )
-        conn.commit()
 
     @commands.command()
     @commands.is_owner()
     async def sendas(self, ctx: commands.context, account: discord.Member, *, msg: str):
-        member = conn.execute(
-            "SELECT * FROM members WHERE id == ?",
-            [account.id],
-        ).fetchone()
+        member = get_member(account.id)
         if member is None:
             await ctx.send("`POLYPHONY SYSTEM UTILITIES` Member Not Found")
             return
@@ -215,17 +196,30 @@ class Debug(commands.Cog):
     @commands.is_owner()
     async def refreshids(self, ctx: commands.context):
         with ctx.typing():
-            all_members = conn.execute("SELECT * FROM members").fetchall()
+            all_members = get_members()
 
             for member in all_members:
-                conn.execute(
-                    "UPDATE members SET id = ? WHERE token = ?",
-                    [decode_token(member["token"]), member["token"]],
-                )
-
-            conn.commit()
+                if member["id"] != decode_token(member["token"]):
+                    update_member(member["id"], id=decode_token(member["token"]))
         await ctx.send("`POLYPHONY SYSTEM UTILITIES` IDs refreshed")
 
+    @commands.command()
+    @commands.check_any(commands.is_owner(), is_mod())
+    async def stats(self, ctx: commands.context):
+        stats = {}
+        events = self.bot.get_cog("Events")
+        if events is not None:
+            stats["messages"] = events.message_count
+            stats["messages_fast_path"] = events.fast_path_count
+            stats["outbox"] = events.outbox.stats()
+        stats["pluralkit_cache"] = pk_cache_stats()
+        stats["tokens"] = token_inventory.stats()
+        stats["log_message_suppressed_edits"] = log_message.suppressed_edits_total
+        stats["database_full_scans"] = check_query_plans()
+        stats_out = pprint.pformat(stats)
+        log.debug(f"\n{stats_out}")
+        await ctx.send(f"```python\n{stats_out}```")
+
 
 def setup(bot: commands.bot):
     log.debug("Debug module loaded")
@@ -10,10 +10,15 @@ from discord.ext import commands
 
 from polyphony.bot import helper
 from polyphony.helpers.checks import is_polyphony_user, is_mod
-from polyphony.helpers.database import c, conn
+from polyphony.helpers.database import (
+    get_member,
+    get_system,
+    update_user,
+)
 from polyphony.helpers.member_list import send_member_list
 from polyphony.helpers.reset import reset
 from polyphony.helpers.sync import sync
+from polyphony.helpers.token_inventory import token_inventory
 from polyphony.instance.bot import PolyphonyInstance
 from polyphony.settings import (
     NEVER_SYNC_ROLES,
@@ -240,15 +245,14 @@ class User(commands.Cog):
         :param ctx: Discord Context
         """
         await ctx.message.delete()
-        c.execute("SELECT * FROM tokens WHERE used = 0")
-        slots = c.fetchall()
-        if 2 > len(slots) >= 1:
+        slots = token_inventory.available
+        if slots == 1:
             embed = discord.Embed(
                 title=f"There is 1 slot available.", color=discord.Color.green()
             )
-        elif len(slots) > 1:
+        elif slots > 1:
             embed = discord.Embed(
-                title=f"There are {len(slots)} slots available",
+                title=f"There are {slots} slots available",
                 color=discord.Color.green(),
             )
         else:
@@ -270,9 +274,8 @@ class User(commands.Cog):
             return
         await sync(
             ctx,
-            conn.execute(
-                "SELECT * FROM members WHERE main_account_id = ?", [ctx.author.id]
-            ).fetchall(),
+            get_system(ctx.author.id),
+            max_age=0,  # Users sync right after editing PluralKit
         )
 
     @sync.command()
@@ -286,9 +289,8 @@ class User(commands.Cog):
         """
         await sync(
             ctx,
-            conn.execute(
-                "SELECT * FROM members WHERE id = ?", [system_member.id]
-            ).fetchall(),
+            [m for m in [get_member(system_member.id)] if m is not None],
+            max_age=0,
         )
 
     @commands.command()
@@ -300,19 +302,14 @@ class User(commands.Cog):
         :param ctx: Discord Context
         """
         log.debug(f"Listing members for {ctx.author.display_name}...")
-        c.execute(
-            "SELECT * FROM members WHERE main_account_id == ?",
-            [ctx.author.id],
-        )
-        member_list = c.fetchall()
+        member_list = get_system(ctx.author.id)
         embed = discord.Embed(title=f"Members of System")
         embed.set_author(name=f"{ctx.author}", icon_url=ctx.author.avatar_url)
         await send_member_list(ctx, embed, member_list, whoarewe=True)
 
     @commands.command()
     async def whois(self, ctx: commands.context, system_member: discord.Member):
-        c.execute("SELECT * FROM members WHERE id == ?", [system_member.id])
-        member = c.fetchone()
+        member = get_member(system_member.id)
         try:
             embed = discord.Embed(
                 description=f"{system_member.mention} is part of the {self.bot.get_user(member['main_account_id']).mention} system",
@@ -334,11 +331,8 @@ class User(commands.Cog):
     async def nick(
         self, ctx: commands.context, ctx_member: discord.Member, *, nickname: str = ""
     ):
-        member = conn.execute(
-            "SELECT * FROM members WHERE main_account_id == ? AND id == ?",
-            [ctx.author.id, ctx_member.id],
-        ).fetchone()
-        if member is not None:
+        member = get_member(ctx_member.id)
+        if member is not None and member["main_account_id"] == ctx.author.id:
             with ctx.channel.typing():
                 embed = discord.Embed(
                     description=f":hourglass: {'Updating' if nickname != '' else 'Clearing'} nickname for {ctx_member.mention}...",
@@ -351,10 +345,7 @@ class User(commands.Cog):
 
                 # Create instance
                 instance = PolyphonyInstance(member["pk_member_id"])
-                asyncio.run_coroutine_threadsafe(
-                    instance.start(member["token"]), self.bot.loop
-                )
-                await instance.wait_until_ready()
+                await instance.login_rest(member["token"])
 
                 out = await instance.update_nickname(nickname)
 
@@ -408,33 +399,17 @@ class User(commands.Cog):
         embed = None
         if (
             type(arg) is discord.Member
-            and conn.execute(
-                "SELECT * FROM members WHERE main_account_id == ? AND id == ?",
-                [ctx.author.id, arg.id],
-            ).fetchone()
-            is not None
+            and arg.id in [m["id"] for m in get_system(ctx.author.id)]
         ):
-            conn.execute(
-                "UPDATE users SET autoproxy_mode = 'member', autoproxy = ? WHERE id == ?",
-                [arg.id, ctx.author.id],
-            )
-            conn.commit()
+            update_user(ctx.author.id, autoproxy_mode="member", autoproxy=arg.id)
             embed = discord.Embed(description=f"Autoproxy set to {arg.mention}")
             embed.set_footer(text="Use ;;ap off to turn autoproxy off")
         elif arg == "latch":
-            conn.execute(
-                "UPDATE users SET autoproxy_mode = 'latch', autoproxy = NULL WHERE id == ?",
-                [ctx.author.id],
-            )
-            conn.commit()
+            update_user(ctx.author.id, autoproxy_mode="latch", autoproxy=None)
             embed = discord.Embed(description=f"Autoproxy set to **latch mode**")
             embed.set_footer(text="Use ;;ap off to turn autoproxy off")
         elif arg == "off":
-            conn.execute(
-                "UPDATE users SET autoproxy_mode = NULL WHERE id == ?",
-                [ctx.author.id],
-            )
-            conn.commit()
+            update_user(ctx.author.id, autoproxy_mode=None)
             embed = discord.Embed(description=f"Autoproxy is now **off**")
         if embed is None and type(arg) is discord.Member:
             embed = discord.Embed(
@@ -459,11 +434,7 @@ class User(commands.Cog):
         ):
             # Don't execute if has role that disables rolesync
             return
-        c.execute(
-            "SELECT * FROM members WHERE main_account_id == ? AND id == ?",
-            [ctx.author.id, system_member.id],
-        )
-        if c.fetchone():
+        if system_member.id in [m["id"] for m in get_system(ctx.author.id)]:
 
             # Get User's Roles
             user_roles = []
@@ -641,11 +612,12 @@ class User(commands.Cog):
         """
         await ctx.message.delete()
         if message is not None:
-            member = conn.execute(
-                "SELECT * FROM members WHERE main_account_id == ? AND id == ? AND member_enabled = 1",
-                [ctx.author.id, message.author.id],
-            ).fetchone()
-            if member:
+            member = get_member(message.author.id)
+            if (
+                member
+                and member["main_account_id"] == ctx.author.id
+                and member["member_enabled"]
+            ):
                 log.debug(
                     f"Editing message {message.id} by {message.author} for {ctx.author}"
                 )
@@ -657,22 +629,13 @@ class User(commands.Cog):
                     await reset()
         else:
             log.debug(f"Editing last Polyphony message for {ctx.author}")
-            member_ids = [
-                member["id"]
-                for member in conn.execute(
-                    "SELECT * FROM members WHERE main_account_id == ?",
-                    [ctx.author.id],
-                ).fetchall()
-            ]
+            member_ids = [member["id"] for member in get_system(ctx.author.id)]
             async for message in ctx.channel.history():
                 if message.author.id in member_ids:
                     while await helper.edit_as(
                         message,
                         content,
-                        conn.execute(
-                            "SELECT * FROM members WHERE id == ?",
-                            [message.author.id],
-                        ).fetchone()["token"],
+                        get_member(message.author.id)["token"],
                     ) is False:
                         await reset()
                     break
@@ -692,11 +655,12 @@ class User(commands.Cog):
         """
         await ctx.message.delete()
         if message is not None:
-            member = conn.execute(
-                "SELECT * FROM members WHERE main_account_id == ? AND id == ? AND member_enabled = 1",
-                [ctx.author.id, message.author.id],
-            ).fetchone()
-            if member:
+            member = get_member(message.author.id)
+            if (
+                member
+                and member["main_account_id"] == ctx.author.id
+                and member["member_enabled"]
+            ):
                 log.debug(
                     f"Deleting message {message.id} by {message.author} for {ctx.author}"
                 )
@@ -706,13 +670,7 @@ class User(commands.Cog):
                 await message.delete()
         else:
             log.debug(f"Deleting last Polyphony message for {ctx.author}")
-            member_ids = [
-                member["id"]
-                for member in conn.execute(
-                    "SELECT * FROM members WHERE main_account_id == ?",
-                    [ctx.author.id],
-                ).fetchall()
-            ]
+            member_ids = [member["id"] for member in get_system(ctx.author.id)]
             async for message in ctx.channel.history():
                 if message.author.id in member_ids:
                     await message.delete()
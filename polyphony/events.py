@@ -1,23 +1,29 @@
 import asyncio
-import json
 import logging
-import re
 import time
 from datetime import timedelta
 
+import aiohttp
 import discord
 import emoji
-import requests
 from discord.ext import commands
-from discord.ext.commands import EmojiConverter
 
 from polyphony.bot import helper, bot
-from polyphony.helpers.database import conn
+from polyphony.helpers.attachments import AttachmentRelay
+from polyphony.helpers.database import (
+    get_instance_owner,
+    get_member,
+    get_system,
+    get_user,
+    set_autoproxy_latch,
+)
 from polyphony.helpers.message_cache import (
     new_proxied_message,
     recently_proxied_messages,
 )
+from polyphony.helpers.outbox import Outbox
 from polyphony.helpers.reset import reset
+from polyphony.helpers.tag_matcher import get_matcher
 from polyphony.settings import (
     COMMAND_PREFIX,
     DELETE_LOGS_CHANNEL_ID,
@@ -31,10 +37,35 @@ class Events(commands.Cog):
     def __init__(self, bot: discord.ext.commands.bot):
         self.bot = bot
         self.edit_session = []
+        self.outbox = Outbox(on_proxied=new_proxied_message)
+        self.message_count = 0
+        self.fast_path_count = 0  # Messages skipped by the admission gate
+
+    @staticmethod
+    def is_relevant(msg: discord.Message) -> bool:
+        """
+        Admission gate for on_message. Only uses in-memory lookups.
+
+        :param msg: Discord message
+        :return: True if the message may need proxying, ping forwarding or delete log cleanup
+        """
+        return (
+            get_user(msg.author.id) is not None
+            or get_member(msg.author.id) is not None
+            or msg.channel.id == DELETE_LOGS_CHANNEL_ID
+            or msg.author.id == DELETE_LOGS_USER_ID
+            or any(get_instance_owner(m.id) is not None for m in msg.mentions)
+        )
 
     @commands.Cog.listener()
     async def on_message(self, msg: discord.Message):
         start = time.time()  # For benchmark debug message
+        self.message_count += 1
+
+        # Skip messages from anyone outside of Polyphony
+        if not self.is_relevant(msg):
+            self.fast_path_count += 1
+            return
 
         # Cancel if using bot command prefix (allows bot commands to run)
         if msg.content.startswith(COMMAND_PREFIX):
@@ -44,11 +75,9 @@ class Events(commands.Cog):
         if msg.author.id in self.edit_session:
             return
 
-        # Get the system
-        system = conn.execute(
-            "SELECT * FROM members WHERE main_account_id == ? AND member_enabled = 1",
-            [msg.author.id],
-        ).fetchall()
+        # Match proxy tags against the author's system
+        matcher = get_matcher(msg.author.id)
+        system = matcher.members
 
         ping_suppress = False  # Set to suppress ping. Used to prevent double ping forwarding with a proxied ping.
 
@@ -59,37 +88,23 @@ class Events(commands.Cog):
         }
         member = None
 
-        # Compile tags with member objects
-        tags = []
-        for m in system:
-            for t in json.loads(m["pk_proxy_tags"]):
-                tags.append([t, m])
-
         # Check tags and set member
-        for tag in tags:
-            if msg.content.startswith(
-                tag[0].get("prefix") or ""
-            ) and msg.content.endswith(tag[0].get("suffix") or ""):
-                member_data["prefix"] = tag[0].get("prefix") or ""
-                member_data["suffix"] = tag[0].get("suffix") or ""
-                member = tag[1]
-                break
+        match = matcher.match(msg.content)
+        if match is not None:
+            member, member_data["prefix"], member_data["suffix"] = match
 
         # Get autoproxy status
         ap_data = {"mode": None, "user": None}
-        db_user = conn.execute(
-            "SELECT * FROM users WHERE id == ?", [msg.author.id]
-        ).fetchone()
+        db_user = get_user(msg.author.id)
         if db_user is not None:
             ap_data["mode"] = db_user["autoproxy_mode"]
             ap_data["user"] = db_user["autoproxy"]
 
         # Check for autoproxy
         if member is None and ap_data["mode"] is not None:
-            member = conn.execute(
-                "SELECT * FROM members WHERE id == ? AND member_enabled = 1",
-                [ap_data["user"]],
-            ).fetchone()
+            member = get_member(ap_data["user"])
+            if member is not None and not member["member_enabled"]:
+                member = None
 
         # Send message if member is set
         if member is not None:
@@ -101,14 +116,8 @@ class Events(commands.Cog):
             if ap_data["mode"] == "latch" and (
                 member_data["prefix"] is not None or member_data["suffix"] is not None
             ):
-                log.debug(f"Setting autoproxy latch to {member['display_name']}")
-
-                # Update database to remember current latch
-                conn.execute(
-                    "UPDATE users SET autoproxy = ? WHERE id == ?",
-                    [member["id"], msg.author.id],
-                )
-                conn.commit()
+                # Remember current latch, written to the database in the background
+                set_autoproxy_latch(msg.author.id, member["id"])
 
             # Remove prefix/suffix
             message = msg.content[
@@ -122,65 +131,74 @@ class Events(commands.Cog):
             else:
                 mention_author = False
 
-            # Send proxied message
-            attempts = 0
-            while await helper.send_as(
-                msg,
-                message,
-                member["token"],
-                files=[await file.to_file() for file in msg.attachments],
-                reference=msg.reference,
-                emote_cache=bot.get_guild(GUILD_ID),  # TODO: Maybe put outside of event
-                mention_author=mention_author
-            ) is False:
-                log.debug(f"Helper failed to send (attempt {attempts} of 3)")
-                attempts += 1
-                await reset()
-            if attempts >= 3:
+            # Start downloading attachments now so they are ready when the message reaches the front of the queue
+            relay = AttachmentRelay(msg.attachments)
+
+            async def send() -> bool:
+                try:
+                    return await send_proxied()
+                except aiohttp.ClientError as e:
+                    log.warning(f"Failed to download attachments of message {msg.id}: {e}")
+                    return False
+                except asyncio.TimeoutError:
+                    log.warning(f"Timed out getting attachments of message {msg.id}")
+                    return False
+                finally:
+                    await relay.close()
+
+            async def send_proxied() -> bool:
+                # Send proxied message
+                for attempt in range(3):
+                    if await helper.send_as(
+                        msg,
+                        message,
+                        member["token"],
+                        files=await relay.files(),
+                        reference=msg.reference,
+                        emote_cache=bot.get_guild(GUILD_ID),
+                        mention_author=mention_author
+                    ) is not False:
+                        end = time.time()  # For benchmarking purposes
+                        log.debug(
+                            f"{member['member_name']} ({member['pk_member_id']}): Benchmark: {timedelta(seconds=end - start)} | Protocol Roundtrip: {timedelta(seconds=self.bot.latency)}"
+                        )
+                        return True
+                    log.debug(f"Helper failed to send (attempt {attempt + 1} of 3)")
+                    await reset()
                 log.error(
                     f"""{member['member_name']} ({member["pk_member_id"]}): Message in {msg.channel} failed to send => "{msg.content}" (attachments: {len(msg.attachments)})"""
                 )
-                return
-            await msg.delete()
+                return False
 
-            # Server log channel message deletion handler (cleans up logging channel)
-            new_proxied_message(msg)
-
-            end = time.time()  # For benchmarking purposes
-            log.debug(
-                f"{member['member_name']} ({member['pk_member_id']}): Benchmark: {timedelta(seconds=end - start)} | Protocol Roundtrip: {timedelta(seconds=self.bot.latency)}"
-            )
+            # Queue behind earlier messages in this channel. The original is deleted once the proxy lands.
+            if not await self.outbox.submit(msg, send):
+                await relay.close()
+                return
 
             ping_suppress = True  # Message was proxied so suppress it
 
-        # Check for ping
-        all_members = conn.execute(
-            "SELECT * FROM members WHERE member_enabled = 1"
-        ).fetchall()
         # Get the database entry for the current member (if any)
-        msg_member = conn.execute(
-            "SELECT * FROM members WHERE id = ?", [msg.author.id]
-        ).fetchone()
+        msg_member = get_member(msg.author.id)
         # Get the system of the current member (if any)
         if msg_member is not None:
-            system = conn.execute(
-                "SELECT * FROM members WHERE main_account_id = ?",
-                [msg_member["main_account_id"]],
-            ).fetchall()
+            system = get_system(msg_member["main_account_id"])
 
+        # Check for ping
         # If a message was proxied, the ping is suppressed to avoid a double-ping from the instance and the original message
-        if not ping_suppress:
-            for member in all_members:
+        if not ping_suppress and msg.mentions:
+            author_owner = get_instance_owner(msg.author.id)
+            for mention in msg.mentions:
+                owner = get_instance_owner(mention.id)
                 # Check for a valid ping
                 if (
-                    member["id"] in [m.id for m in msg.mentions]
-                    and msg.author.id != member["main_account_id"]
-                    and msg.author.id != member["id"]
+                    owner is not None
+                    and msg.author.id != owner
+                    and msg.author.id != mention.id
                     and msg.author.id != self.bot.user.id
                     and not msg.content.startswith(COMMAND_PREFIX)
                 ):
                     embed = discord.Embed(
-                        description=f"Originally to {self.bot.get_user(member['id']).mention}\n[Highlight Message]({msg.jump_url})"
+                        description=f"Originally to {self.bot.get_user(mention.id).mention}\n[Highlight Message]({msg.jump_url})"
                     )
                     embed.set_author(
                         name=f"From {msg.author}",
@@ -188,27 +206,25 @@ class Events(commands.Cog):
                     )
 
                     # Check if ping is from another Polyphony instance
-                    if msg.author.bot is True and msg.author.id in [
-                        m["id"] for m in all_members
-                    ]:
+                    if msg.author.bot is True and author_owner is not None:
                         # Check member isn't part of author's own system
-                        if member["id"] not in [m["id"] for m in system]:
+                        if owner != author_owner:
                             # Forward Ping from Instance
                             log.debug(
-                                f"Forwarding ping from {member['id']} to {member['main_account_id']} (from proxy)"
+                                f"Forwarding ping from {mention.id} to {owner} (from proxy)"
                             )
                             await self.bot.get_channel(msg.channel.id).send(
-                                f"{self.bot.get_user(member['main_account_id']).mention}",
+                                f"{self.bot.get_user(owner).mention}",
                                 embed=embed,
                             )
                     else:
                         # Forward Ping from non-polyphony instance
                         log.debug(
-                            f"Forwarding ping from {member['id']} to {member['main_account_id']}"
+                            f"Forwarding ping from {mention.id} to {owner}"
                         )
 
                         await self.bot.get_channel(msg.channel.id).send(
-                            f"{self.bot.get_user(member['main_account_id']).mention}",
+                            f"{self.bot.get_user(owner).mention}",
                             embed=embed,
                         )
                     break
@@ -236,10 +252,11 @@ class Events(commands.Cog):
 
     @commands.Cog.listener()
     async def on_reaction_add(self, reaction: discord.Reaction, user: discord.Member):
-        member = conn.execute(
-            "SELECT * FROM members WHERE main_account_id == ? AND id = ? AND member_enabled = 1",
-            [user.id, reaction.message.author.id],
-        ).fetchone()
+        member = get_member(reaction.message.author.id)
+        if member is not None and (
+            member["main_account_id"] != user.id or not member["member_enabled"]
+        ):
+            member = None
 
         # Check for correct user
         if member is not None:
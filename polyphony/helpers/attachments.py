@@ -0,0 +1,149 @@
+"""
+Streaming attachment relay for proxied messages.
+
+Attachments are downloaded concurrently in the background as soon as a message is queued, so the download overlaps
+with the rest of the send pipeline. Small attachments stay in memory and larger ones are spooled to temporary files.
+The total size of downloaded-but-unsent attachments is capped.
+"""
+import asyncio
+import logging
+import tempfile
+from collections import deque
+from typing import Deque, List, Optional, Tuple
+
+import discord
+
+from polyphony.helpers.http import get_session
+from polyphony.settings import ATTACHMENT_BUDGET_TIMEOUT, ATTACHMENT_INFLIGHT_MAX, ATTACHMENT_SPOOL_THRESHOLD
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+
+
+class ByteBudget:
+    """
+    Caps the number of attachment bytes in flight across all messages
+
+    Bytes are handed out strictly in request order. A message can only hold bytes if every message queued before it
+    holds bytes too, so a later message in a channel can never starve the message in front of it in the outbox.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self.waiters: Deque[Tuple[int, asyncio.Future]] = deque()
+
+    async def acquire(self, size: int, timeout: Optional[float] = None) -> int:
+        """
+        Wait until `size` bytes are available
+
+        Requests larger than the whole budget wait for an empty budget instead of waiting forever.
+
+        :param timeout: Seconds to wait before raising asyncio.TimeoutError, None to wait forever
+        :return: Number of bytes reserved, to be passed to release()
+        """
+        size = min(size, self.limit)
+        if not self.waiters and self.used + size <= self.limit:
+            self.used += size
+            return size
+        waiter = asyncio.get_event_loop().create_future()
+        entry = (size, waiter)
+        self.waiters.append(entry)
+        try:
+            await asyncio.wait_for(waiter, timeout)
+        except BaseException:
+            if waiter.done() and not waiter.cancelled():
+                # Granted just as the wait ended
+                await self.release(size)
+            else:
+                try:
+                    self.waiters.remove(entry)
+                except ValueError:
+                    pass
+                self._wake()  # Requests queued behind this one may fit now
+            raise
+        return size
+
+    def _wake(self):
+        while self.waiters:
+            size, waiter = self.waiters[0]
+            if waiter.done():
+                self.waiters.popleft()
+            elif self.used + size <= self.limit:
+                self.waiters.popleft()
+                self.used += size
+                waiter.set_result(None)
+            else:
+                break
+
+    async def release(self, size: int):
+        if not size:
+            return
+        self.used -= size
+        self._wake()
+
+
+budget = ByteBudget(ATTACHMENT_INFLIGHT_MAX)
+
+
+async def _download(attachment: discord.Attachment, spool):
+    async with get_session().get(attachment.url) as response:
+        response.raise_for_status()
+        async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+            spool.write(chunk)
+
+
+class AttachmentRelay:
+    """Relays the attachments of one message"""
+
+    def __init__(self, attachments: List[discord.Attachment]):
+        self.attachments = attachments
+        self.spools = []
+        self.opened_files: List[discord.File] = []
+        self.reserved = 0
+        self.task = asyncio.create_task(self._download()) if attachments else None
+
+    async def _download(self):
+        self.reserved = await budget.acquire(sum(a.size for a in self.attachments), ATTACHMENT_BUDGET_TIMEOUT)
+        self.spools = [
+            tempfile.SpooledTemporaryFile(max_size=ATTACHMENT_SPOOL_THRESHOLD)
+            for _ in self.attachments
+        ]
+        await asyncio.gather(
+            *[_download(a, spool) for a, spool in zip(self.attachments, self.spools)]
+        )
+
+    async def files(self) -> List[discord.File]:
+        """
+        Wait for the downloads to finish and wrap them as files ready to upload
+
+        Can be called again for a retry, each call returns fresh files positioned at the start.
+        """
+        if self.task is None:
+            return []
+        await self.task
+        files = []
+        for attachment, spool in zip(self.attachments, self.spools):
+            spool.seek(0)
+            files.append(discord.File(spool, filename=attachment.filename))
+        self.opened_files.extend(files)
+        return files
+
+    async def close(self):
+        """Discard downloads and return their bytes to the budget"""
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+            try:
+                await self.task
+            except (asyncio.CancelledError, Exception):
+                pass
+        # discord.File stubs out close() on file objects until the File itself is closed
+        for file in self.opened_files:
+            file.close()
+        for spool in self.spools:
+            spool.close()
+        self.opened_files = []
+        self.spools = []
+        await budget.release(self.reserved)
+        self.reserved = 0
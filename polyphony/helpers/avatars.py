@@ -0,0 +1,275 @@
+"""
+Async avatar fetching with an on-disk content-addressed cache.
+
+Avatars are downloaded through the shared HTTP session with a timeout and a size cap. Every downloaded image is stored
+under its SHA-256 digest, so the same image is never stored twice. URLs that were already downloaded are mapped to
+their digest, so they are served from disk (also after a restart) instead of being downloaded again. The cache is kept
+under AVATAR_CACHE_MAX_SIZE by deleting the least recently used files.
+
+Before upload, avatars are downsized and re-encoded in a process pool if Pillow is installed. Normalized images are
+cached by the digest of their source image.
+"""
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from io import BytesIO
+from typing import List, Optional, Tuple
+
+import aiohttp
+
+from polyphony.helpers.http import get_session
+from polyphony.settings import (
+    AVATAR_CACHE_DIR,
+    AVATAR_CACHE_MAX_SIZE,
+    AVATAR_FETCH_TIMEOUT,
+    AVATAR_MAX_SIZE,
+    AVATAR_WORKERS,
+)
+
+log = logging.getLogger(__name__)
+
+# Check for Pillow
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+    log.debug("Pillow not loaded. Avatars will be uploaded without normalization.")
+
+CHUNK_SIZE = 64 * 1024
+
+# URLs are downloaded again after this many seconds in case the image behind them changed
+URL_MAX_AGE = 24 * 60 * 60
+
+# Avatars are downsized to fit this resolution, the largest size Discord displays them at
+AVATAR_RESOLUTION = 512
+
+# Images already within the resolution and smaller than this are uploaded as is
+NORMALIZE_MIN_SIZE = 256 * 1024
+
+# Once the cache is over AVATAR_CACHE_MAX_SIZE, files are deleted until it's down to this share of it
+CACHE_EVICT_TO = 0.9
+
+_executor: Optional[Executor] = None
+
+# Approximate size of the cache in bytes, counted from disk on the first write
+_cache_size: Optional[int] = None
+_cache_lock = threading.Lock()
+
+
+class AvatarTooLarge(Exception):
+    pass
+
+
+def _path(digest: str) -> str:
+    return os.path.join(AVATAR_CACHE_DIR, digest)
+
+
+def _url_path(url: str) -> str:
+    return os.path.join(AVATAR_CACHE_DIR, "urls", hashlib.sha256(url.encode()).hexdigest())
+
+
+def _write(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write to a temporary file first so a crash never leaves a truncated file behind. Every write gets its own
+    # temporary file, the same path can be written by several threads at once.
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    _account(len(data))
+
+
+def _read(path: str, touch: bool = False) -> Optional[bytes]:
+    """
+    Read a file from the cache
+
+    :param touch: Mark the file as recently used so it is evicted last
+    :return: File contents or None if the file doesn't exist
+    """
+    try:
+        with open(path, "rb") as file:
+            data = file.read()
+        if touch:
+            os.utime(path)
+        return data
+    except FileNotFoundError:
+        return None
+
+
+def _cache_files() -> List[Tuple[float, int, str]]:
+    """:return: (modification time, size, path) of every file in the cache"""
+    files = []
+    for directory, _, names in os.walk(AVATAR_CACHE_DIR):
+        for name in names:
+            if name.endswith(".tmp"):  # Still being written
+                continue
+            path = os.path.join(directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+    return files
+
+
+def _account(size: int):
+    """Count bytes written to the cache and evict the least recently used files once it's over the limit"""
+    global _cache_size
+    with _cache_lock:
+        if _cache_size is None:
+            _cache_size = sum(file_size for _, file_size, _ in _cache_files())
+        else:
+            _cache_size += size
+        if _cache_size <= AVATAR_CACHE_MAX_SIZE:
+            return
+        files = sorted(_cache_files())
+        _cache_size = sum(file_size for _, file_size, _ in files)
+        evicted = 0
+        for _, file_size, path in files:
+            if _cache_size <= AVATAR_CACHE_MAX_SIZE * CACHE_EVICT_TO:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            _cache_size -= file_size
+            evicted += 1
+        log.debug(f"Evicted {evicted} file(s) from the avatar cache ({_cache_size} bytes left)")
+
+
+def _store(digest: str, data: bytes, url: Optional[str]):
+    if not os.path.exists(_path(digest)):
+        _write(_path(digest), data)
+    if url is not None:
+        _write(_url_path(url), digest.encode())
+
+
+def _lookup(url: str) -> Optional[Tuple[bytes, str]]:
+    try:
+        if time.time() - os.path.getmtime(_url_path(url)) > URL_MAX_AGE:
+            return None
+    except FileNotFoundError:
+        return None
+    digest = _read(_url_path(url))
+    if digest is None:
+        return None
+    data = _read(_path(digest.decode()), touch=True)
+    if data is None:
+        return None
+    return data, digest.decode()
+
+
+async def store_avatar(data: bytes, url: Optional[str] = None) -> str:
+    """
+    Store an image in the avatar cache
+
+    :param data: Image
+    :param url: URL the image was downloaded from
+    :return: SHA-256 digest of the image
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    await asyncio.get_event_loop().run_in_executor(None, _store, digest, data, url)
+    return digest
+
+
+async def fetch_avatar(url: str) -> Tuple[bytes, str]:
+    """
+    Get an avatar from the cache or download and store it
+
+    :param url: Image URL
+    :return: (image, SHA-256 digest)
+    :raises AvatarTooLarge: The image is larger than AVATAR_MAX_SIZE
+    :raises aiohttp.ClientError: The download failed
+    :raises asyncio.TimeoutError: The download took longer than AVATAR_FETCH_TIMEOUT
+    """
+    cached = await asyncio.get_event_loop().run_in_executor(None, _lookup, url)
+    if cached is not None:
+        log.debug(f"Avatar {url} is cached")
+        return cached
+
+    log.debug(f"Fetching avatar {url}")
+    timeout = aiohttp.ClientTimeout(total=AVATAR_FETCH_TIMEOUT)
+    async with get_session().get(url, timeout=timeout) as response:
+        response.raise_for_status()
+        if (response.content_length or 0) > AVATAR_MAX_SIZE:
+            raise AvatarTooLarge(url)
+        data = bytearray()
+        async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+            data += chunk
+            if len(data) > AVATAR_MAX_SIZE:
+                raise AvatarTooLarge(url)
+    data = bytes(data)
+    return data, await store_avatar(data, url)
+
+
+def _normalize(data: bytes) -> bytes:
+    """Downsize and re-encode an image. Runs in the process pool."""
+    image = Image.open(BytesIO(data))
+    if image.width <= AVATAR_RESOLUTION and image.height <= AVATAR_RESOLUTION and len(data) <= NORMALIZE_MIN_SIZE:
+        return data
+    # Animated avatars are reduced to their first frame
+    image.seek(0)
+    has_alpha = image.mode in ("RGBA", "LA", "PA") or (image.mode == "P" and "transparency" in image.info)
+    image = image.convert("RGBA" if has_alpha else "RGB")
+    image.thumbnail((AVATAR_RESOLUTION, AVATAR_RESOLUTION), Image.LANCZOS)
+    output = BytesIO()
+    if has_alpha:
+        image.save(output, format="PNG", optimize=True)
+    else:
+        image.save(output, format="JPEG", quality=90, optimize=True)
+    normalized = output.getvalue()
+    return normalized if len(normalized) < len(data) else data
+
+
+def _make_executor() -> Executor:
+    # Workers must be forked. Spawned workers import this module, and importing the polyphony package starts the bot.
+    # Without fork (Windows) images are normalized on threads instead, Pillow releases the GIL for most of the work.
+    try:
+        context = multiprocessing.get_context("fork")
+    except ValueError:
+        return ThreadPoolExecutor(max_workers=AVATAR_WORKERS, thread_name_prefix="polyphony-avatar")
+    return ProcessPoolExecutor(max_workers=AVATAR_WORKERS, mp_context=context)
+
+
+def _normalized_path(digest: str) -> str:
+    return os.path.join(AVATAR_CACHE_DIR, "normalized", digest)
+
+
+async def normalize_avatar(data: bytes, digest: str) -> bytes:
+    """
+    Downsize and re-encode an avatar for upload
+
+    Returns the image unchanged if Pillow is not installed or the image can't be decoded.
+
+    :param data: Image
+    :param digest: SHA-256 digest of the image
+    :return: Normalized image
+    """
+    global _executor
+    if Image is None:
+        return data
+    loop = asyncio.get_event_loop()
+    normalized = await loop.run_in_executor(None, _read, _normalized_path(digest), True)
+    if normalized is not None:
+        return normalized
+
+    if _executor is None:
+        _executor = _make_executor()
+    try:
+        normalized = await loop.run_in_executor(_executor, _normalize, data)
+    except Exception as e:
+        log.debug(f"Could not normalize avatar {digest} ({e!r}). Uploading it as is.")
+        return data
+    log.debug(f"Normalized avatar {digest} ({len(data)} -> {len(normalized)} bytes)")
+    await loop.run_in_executor(None, _write, _normalized_path(digest), normalized)
+    return normalized
@@ -7,7 +7,7 @@ import logging
 import discord
 from discord.ext import commands
 
-from polyphony.helpers.database import conn
+from polyphony.helpers.database import get_user
 from polyphony.settings import MODERATOR_ROLES
 
 log = logging.getLogger(__name__)
@@ -35,10 +35,7 @@ def is_polyphony_user():
     """
     # TODO: Add error message that self deletes
     async def predicate(ctx: commands.context):
-        user = conn.execute(
-            "SELECT * FROM users WHERE id = ?", [ctx.author.id]
-        ).fetchone()
-        if user is not None:
+        if get_user(ctx.author.id) is not None:
             return True
         else:
             return False
@@ -1,26 +1,69 @@
 """
 Contains all database functions.
 """
+import asyncio
+import functools
 import json
 import logging
 import os
+import queue
 import shutil
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
 import sqlite3
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
 
-from polyphony.settings import DATABASE_URI
-
-conn = sqlite3.connect(DATABASE_URI)
-conn.row_factory = sqlite3.Row
-c = conn.cursor()
+from polyphony.settings import AUTOPROXY_FLUSH_INTERVAL, DATABASE_URI, DB_READERS
 
 log = logging.getLogger(__name__)
 
-schema_version = 5
+schema_version = 10
+
+# Most write jobs committed in one transaction by the writer thread
+GROUP_COMMIT_MAX = 100
+
+# Connection tuning
+MMAP_SIZE = 64 * 1024 * 1024  # Bytes of the database file mapped into memory
+CACHE_SIZE_KIB = 16 * 1024  # Page cache per connection
+
+# Queries that must be answered from an index. The in-memory repository serves these lookups at runtime, but they are
+# what reloads, tooling and every write by key hit in SQLite, so they are checked against the query planner.
+HOT_QUERIES = (
+    "SELECT id FROM members WHERE main_account_id = ? AND member_enabled = ?",
+    "SELECT id FROM members WHERE member_enabled = ?",
+    "SELECT token FROM tokens WHERE used = ?",
+    "SELECT * FROM members WHERE id = ?",
+    "SELECT * FROM members WHERE pk_member_id = ?",
+    "SELECT * FROM tokens WHERE token = ?",
+    "SELECT * FROM sync_state WHERE member_id = ?",
+    "SELECT member_id FROM proxy_tags WHERE prefix = ? AND suffix = ?",
+    "SELECT prefix, suffix FROM proxy_tags WHERE member_id = ?",
+    "SELECT edited_at FROM profile_edits WHERE member_id = ? AND kind = ? AND edited_at >= ? ORDER BY edited_at",
+)
+
+
+def _connect() -> sqlite3.Connection:
+    connection = sqlite3.connect(DATABASE_URI)
+    connection.row_factory = sqlite3.Row
+    # WAL lets the reader threads run alongside the writer. Only the journal mode is stored in the database file, so
+    # the other pragmas are applied to every connection.
+    connection.execute("PRAGMA journal_mode = WAL")
+    connection.execute("PRAGMA synchronous = NORMAL")
+    connection.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+    connection.execute(f"PRAGMA cache_size = -{CACHE_SIZE_KIB}")
+    return connection
+
+
+# Only used on the event loop thread for migrations and loading the in-memory repository
+conn = _connect()
 
 
 def init_db():
     """Initialize database tables migrations directory schema"""
+    # On reload, queued writes must land before migrating and reloading the in-memory repository
+    flush_autoproxy_latches()
+    _wait_for_writes()
     try:
         version = conn.execute("SELECT * FROM meta").fetchone()
     except sqlite3.OperationalError:
@@ -49,6 +92,7 @@ def init_db():
     for v in range(0, schema_version + 1):
         if version < v:
             log.info(f"Updating database to schema version {v}")
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")  # Backups must include everything still in the WAL
             shutil.copyfile(DATABASE_URI, f"{DATABASE_URI}.v{version}.bak")
             with open(
                 f"{Path(os.path.dirname(os.path.abspath(__file__))).parent.absolute()}/migrations/v{v}.sqlite", "r"
@@ -57,10 +101,446 @@ def init_db():
             conn.executescript(schema)
     conn.commit()
     log.info(f"Database initialized (Version {schema_version})")
+    for sql, plan in check_query_plans().items():
+        log.error(f"Hot query does a full table scan: {sql} ({plan})")
+    load_cache()
+    _start_threads()
     return schema_version
 
 
-def insert_member(
+def check_query_plans(connection: Optional[sqlite3.Connection] = None) -> Dict[str, str]:
+    """
+    Check that the hot queries are answered from an index
+
+    :param connection: Connection to check with, the migration connection by default
+    :return: Query -> query plan of every hot query that scans a table
+    """
+    connection = connection or conn
+    scans = {}
+    for sql in HOT_QUERIES:
+        plan = [
+            row["detail"]
+            for row in connection.execute(f"EXPLAIN QUERY PLAN {sql}", [None] * sql.count("?")).fetchall()
+        ]
+        if any(detail.startswith("SCAN") for detail in plan):
+            scans[sql] = "; ".join(plan)
+    return scans
+
+
+# Database threads
+#
+# Writes never run on the event loop. They are queued to a single writer thread, which commits everything that queued
+# up while the previous transaction was running in one transaction (group commit). Reads that aren't served from memory
+# run on a small pool of reader threads, each with its own connection. Every statement gets its own cursor.
+
+Statement = Tuple[str, list]
+
+
+class _Writer(threading.Thread):
+    def __init__(self):
+        super().__init__(name="polyphony-db-writer", daemon=True)
+        self.queue: "queue.Queue[Optional[Tuple[Tuple[Statement, ...], Future]]]" = queue.Queue()
+
+    def run(self):
+        connection = _connect()
+        connection.isolation_level = None  # Transactions are managed explicitly
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            while len(batch) < GROUP_COMMIT_MAX:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                running = False
+                batch = [job for job in batch if job is not None]
+
+            results = []
+            connection.execute("BEGIN")
+            for statements, future in batch:
+                # The caller gave up on the write before it started, so it is skipped. Once running, it can't be
+                # cancelled anymore and its result can always be set.
+                if not future.set_running_or_notify_cancel():
+                    continue
+                # A failed job is rolled back on its own without affecting the rest of the batch
+                connection.execute("SAVEPOINT job")
+                try:
+                    rows = []
+                    for sql, params in statements:
+                        rows = [dict(row) for row in connection.execute(sql, params).fetchall()]
+                    connection.execute("RELEASE job")
+                    results.append((future, rows, None))
+                except sqlite3.Error as e:
+                    # Parameters are left out, they can hold bot tokens
+                    log.error(f"Database write failed: {e} ({'; '.join(sql for sql, _ in statements)})")
+                    connection.execute("ROLLBACK TO job")
+                    connection.execute("RELEASE job")
+                    results.append((future, None, e))
+            try:
+                connection.execute("COMMIT")
+            except sqlite3.Error as e:
+                log.error(f"Database commit failed: {e}")
+                connection.execute("ROLLBACK")
+                results = [(future, None, e) for future, _, _ in results]
+
+            for future, rows, error in results:
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(rows)
+        connection.close()
+
+
+_writer: Optional[_Writer] = None
+_readers: Optional[ThreadPoolExecutor] = None
+_reader_connections = threading.local()
+_last_write: Optional[Future] = None
+
+
+def _start_threads():
+    global _writer, _readers
+    if _writer is None or not _writer.is_alive():
+        _writer = _Writer()
+        _writer.start()
+    if _readers is None:
+        _readers = ThreadPoolExecutor(max_workers=DB_READERS, thread_name_prefix="polyphony-db-reader")
+
+
+def _write(*statements: Statement, on_done: Optional[Callable[[Future], None]] = None) -> Future:
+    """
+    Queue statements to be executed in one transaction by the writer thread
+
+    :param on_done: Called on the event loop with the future once the write finished
+    :return: Future of the rows returned by the last statement
+    """
+    global _last_write
+    _start_threads()
+    future = Future()
+    try:
+        loop = asyncio.get_event_loop()
+    except RuntimeError:
+        loop = None  # No event loop anymore during shutdown
+    if on_done is not None and loop is not None:
+
+        def call_on_loop(f: Future):
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(on_done, f)
+
+        future.add_done_callback(call_on_loop)
+    _writer.queue.put((statements, future))
+    _last_write = future
+    return future
+
+
+def _wait_for_writes():
+    """Block until every write queued so far is committed"""
+    if _writer is not None and _writer.is_alive():
+        _write().result()  # Jobs run in order, so an empty job finishes after all earlier ones
+
+
+def _read(sql: str, params: list) -> List[dict]:
+    connection = getattr(_reader_connections, "connection", None)
+    if connection is None:
+        connection = _reader_connections.connection = _connect()
+    return [dict(row) for row in connection.execute(sql, params).fetchall()]
+
+
+async def fetch(sql: str, params: list = ()) -> List[dict]:
+    """
+    Run a read query on the reader pool
+
+    Waits for all writes queued so far, so reads always see earlier writes.
+    """
+    if _last_write is not None and not _last_write.done():
+        await asyncio.wait([asyncio.wrap_future(_last_write)])
+    _start_threads()
+    return await asyncio.get_event_loop().run_in_executor(_readers, _read, sql, list(params))
+
+
+def close_db():
+    """Commit queued writes and stop the database threads"""
+    global _writer, _readers
+    flush_autoproxy_latches()
+    if _writer is not None and _writer.is_alive():
+        _writer.queue.put(None)
+        _writer.join()
+    _writer = None
+    if _readers is not None:
+        _readers.shutdown()
+        _readers = None
+
+
+# In-memory repository
+#
+# Members, users and tokens are loaded into memory on initialization and served from indexed dicts.
+# All writes go through the functions below, which keep the indexes up to date and queue the write to SQLite.
+# Rows are plain dicts and are replaced (never mutated) on update, so a row handed out stays a consistent snapshot.
+# Member rows carry their proxy tags from the proxy_tags table as a tuple of (prefix, suffix) under "proxy_tags".
+
+MEMBER_COLUMNS = (
+    "token",
+    "pk_member_id",
+    "main_account_id",
+    "id",
+    "member_name",
+    "display_name",
+    "pk_avatar_url",
+    "pk_keep_proxy",
+    "member_enabled",
+    "nickname",
+)
+USER_COLUMNS = ("id", "autoproxy_mode", "autoproxy")
+
+_members: Dict[int, dict] = {}
+_members_by_system: Dict[int, Dict[int, dict]] = {}
+_members_by_pk_id: Dict[str, dict] = {}
+_members_by_token: Dict[str, dict] = {}
+_instance_owners: Dict[int, int] = {}  # Enabled instance ID -> main account ID
+_users: Dict[int, dict] = {}
+_tokens: Dict[str, dict] = {}
+
+_system_listeners: List[Callable[[int], None]] = []
+_token_listeners: List[Callable[[str], None]] = []
+
+ProxyTags = Tuple[Tuple[str, str], ...]
+
+# Inserts all tags of a member in one statement from a JSON array of [prefix, suffix] pairs
+INSERT_PROXY_TAGS = (
+    "INSERT OR IGNORE INTO proxy_tags (member_id, prefix, suffix) "
+    "SELECT ?, json_extract(value, '$[0]'), json_extract(value, '$[1]') FROM json_each(?)"
+)
+
+
+def add_system_listener(callback: Callable[[int], None]):
+    """
+    Register a callback to be called with the main account ID whenever members of a system change
+
+    :param callback: Function taking a main account ID
+    """
+    _system_listeners.append(callback)
+
+
+def _notify_system(main_account_id: int):
+    for callback in _system_listeners:
+        callback(main_account_id)
+
+
+def add_token_listener(callback: Callable[[str], None]):
+    """
+    Register a callback to be called with the token whenever a token is added or changes
+
+    :param callback: Function taking a token
+    """
+    _token_listeners.append(callback)
+
+
+def _notify_token(token: str):
+    for callback in _token_listeners:
+        callback(token)
+
+
+def _index_member(member: dict):
+    _members[member["id"]] = member
+    _members_by_system.setdefault(member["main_account_id"], {})[member["id"]] = member
+    _members_by_pk_id[member["pk_member_id"]] = member
+    if member["token"] is not None:
+        _members_by_token[member["token"]] = member
+    if member["member_enabled"]:
+        _instance_owners[member["id"]] = member["main_account_id"]
+
+
+def _unindex_member(member: dict):
+    _members.pop(member["id"], None)
+    system = _members_by_system.get(member["main_account_id"])
+    if system is not None:
+        system.pop(member["id"], None)
+        if not system:
+            del _members_by_system[member["main_account_id"]]
+    _members_by_pk_id.pop(member["pk_member_id"], None)
+    if member["token"] is not None:
+        _members_by_token.pop(member["token"], None)
+    _instance_owners.pop(member["id"], None)
+
+
+def normalize_proxy_tags(tags: Optional[List[dict]]) -> ProxyTags:
+    """
+    Convert PluralKit proxy tags to (prefix, suffix) pairs
+
+    Missing prefixes and suffixes become empty strings. Empty tags and duplicates are dropped.
+
+    :param tags: Proxy tags as returned by PluralKit
+    """
+    pairs = []
+    for tag in tags or []:
+        pair = (tag.get("prefix") or "", tag.get("suffix") or "")
+        if pair != ("", "") and pair not in pairs:
+            pairs.append(pair)
+    return tuple(pairs)
+
+
+def _insert_proxy_tags(member_id: int, tags: ProxyTags) -> Statement:
+    return INSERT_PROXY_TAGS, [member_id, json.dumps(tags)]
+
+
+def load_cache():
+    """Load members, users and tokens from the database into memory"""
+    previous_systems = set(_members_by_system)
+    previous_tokens = set(_tokens)
+    _members.clear()
+    _members_by_system.clear()
+    _members_by_pk_id.clear()
+    _members_by_token.clear()
+    _instance_owners.clear()
+    _users.clear()
+    _tokens.clear()
+    tags: Dict[int, list] = {}
+    for row in conn.execute("SELECT member_id, prefix, suffix FROM proxy_tags ORDER BY member_id, rowid").fetchall():
+        tags.setdefault(row["member_id"], []).append((row["prefix"], row["suffix"]))
+    for row in conn.execute("SELECT * FROM members").fetchall():
+        _index_member({**row, "proxy_tags": tuple(tags.get(row["id"], ()))})
+    for row in conn.execute("SELECT * FROM users").fetchall():
+        _users[row["id"]] = dict(row)
+    for row in conn.execute("SELECT * FROM tokens").fetchall():
+        _tokens[row["token"]] = dict(row)
+    for main_account_id in previous_systems | set(_members_by_system):
+        _notify_system(main_account_id)
+    for token in previous_tokens | set(_tokens):
+        _notify_token(token)
+    log.debug(
+        f"Loaded {len(_members)} members, {len(_users)} users and {len(_tokens)} tokens into memory"
+    )
+
+
+# Memory is updated as soon as a write is queued. When the write fails, the affected rows are reloaded from the
+# database, so memory never stays out of step with SQLite.
+
+
+def _reload_on_failure(reload: Callable[[], Awaitable[None]]) -> Callable[[Future], None]:
+    def on_done(future: Future):
+        if not future.cancelled() and future.exception() is not None:
+            asyncio.ensure_future(reload())
+
+    return on_done
+
+
+def _placeholders(values: Iterable) -> str:
+    return ", ".join("?" for _ in values)
+
+
+async def _reload_members(*ids: int):
+    rows = await fetch(f"SELECT * FROM members WHERE id IN ({_placeholders(ids)})", ids)
+    tags: Dict[int, list] = {}
+    for row in await fetch(
+        f"SELECT member_id, prefix, suffix FROM proxy_tags WHERE member_id IN ({_placeholders(ids)}) "
+        "ORDER BY member_id, rowid",
+        ids,
+    ):
+        tags.setdefault(row["member_id"], []).append((row["prefix"], row["suffix"]))
+    systems = set()
+    for id in ids:
+        member = _members.get(id)
+        if member is not None:
+            _unindex_member(member)
+            systems.add(member["main_account_id"])
+    for row in rows:
+        _index_member({**row, "proxy_tags": tuple(tags.get(row["id"], ()))})
+        systems.add(row["main_account_id"])
+    for main_account_id in systems:
+        _notify_system(main_account_id)
+    log.warning(f"Reloaded member(s) {', '.join(map(str, ids))} after a failed write")
+
+
+async def _reload_users(*ids: int):
+    rows = {row["id"]: row for row in await fetch(f"SELECT * FROM users WHERE id IN ({_placeholders(ids)})", ids)}
+    for id in ids:
+        if id in rows:
+            _users[id] = rows[id]
+        else:
+            _users.pop(id, None)
+    log.warning(f"Reloaded user(s) {', '.join(map(str, ids))} after a failed write")
+
+
+async def _reload_token(token: str):
+    rows = await fetch("SELECT * FROM tokens WHERE token = ?", [token])
+    if rows:
+        _tokens[token] = rows[0]
+    else:
+        _tokens.pop(token, None)
+    _notify_token(token)
+    log.warning("Reloaded a token after a failed write")
+
+
+def get_member(id: int) -> Optional[dict]:
+    return _members.get(id)
+
+
+def get_member_by_pk_id(pk_member_id: str) -> Optional[dict]:
+    return _members_by_pk_id.get(pk_member_id)
+
+
+def get_member_by_token(token: str) -> Optional[dict]:
+    return _members_by_token.get(token)
+
+
+def get_instance_owner(id: int) -> Optional[int]:
+    """
+    Get the main account ID owning an enabled instance
+
+    :param id: Member (instance) ID
+    :return: Main account ID or None if the ID is not an enabled instance
+    """
+    return _instance_owners.get(id)
+
+
+def get_members(enabled: Optional[bool] = None) -> List[dict]:
+    """
+    Get all members
+
+    :param enabled: Only return enabled (True) or suspended (False) members
+    """
+    if enabled is None:
+        return list(_members.values())
+    return [m for m in _members.values() if bool(m["member_enabled"]) == enabled]
+
+
+def get_system(main_account_id: int, enabled: Optional[bool] = None) -> List[dict]:
+    """
+    Get all members of a system
+
+    :param main_account_id: Main account ID of the system
+    :param enabled: Only return enabled (True) or suspended (False) members
+    """
+    system = _members_by_system.get(main_account_id, {}).values()
+    if enabled is None:
+        return list(system)
+    return [m for m in system if bool(m["member_enabled"]) == enabled]
+
+
+def get_user(id: int) -> Optional[dict]:
+    return _users.get(id)
+
+
+def get_token(token: str) -> Optional[dict]:
+    return _tokens.get(token)
+
+
+def get_tokens(used: Optional[bool] = None) -> List[dict]:
+    """
+    Get all tokens
+
+    :param used: Only return used (True) or free (False) tokens
+    """
+    if used is None:
+        return list(_tokens.values())
+    return [t for t in _tokens.values() if bool(t["used"]) == used]
+
+
+def count_tokens() -> int:
+    return len(_tokens)
+
+
+async def insert_member(
     token: str,
     pk_member_id: str,
     main_account_id: int,
@@ -68,25 +548,332 @@ def insert_member(
     member_name: str,
     display_name: str,
     pk_avatar_url: str,
-    pk_proxy_tags: dict,
+    pk_proxy_tags: List[dict],
     pk_keep_proxy: bool,
     member_enabled: bool,
 ):
     log.debug(f"Inserting member {member_name} ({pk_member_id}) into database...")
-    conn.execute(
-        "INSERT INTO members VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-        [
-            token,
-            pk_member_id,
-            main_account_id,
-            id,
-            member_name,
-            display_name,
-            pk_avatar_url,
-            json.dumps(pk_proxy_tags),
-            pk_keep_proxy,
-            member_enabled,
-            None,
+    member = {
+        "token": token,
+        "pk_member_id": pk_member_id,
+        "main_account_id": main_account_id,
+        "id": id,
+        "member_name": member_name,
+        "display_name": display_name,
+        "pk_avatar_url": pk_avatar_url,
+        "pk_keep_proxy": pk_keep_proxy,
+        "member_enabled": member_enabled,
+        "nickname": None,
+    }
+    proxy_tags = normalize_proxy_tags(pk_proxy_tags)
+
+    # The member is cached once the insert is committed, even if the caller stopped waiting
+    def committed(future: Future):
+        if not future.cancelled() and future.exception() is None:
+            _index_member({**member, "proxy_tags": proxy_tags})
+            _notify_system(main_account_id)
+
+    future = _write(
+        ("INSERT INTO members VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", [member[column] for column in MEMBER_COLUMNS]),
+        _insert_proxy_tags(id, proxy_tags),
+        on_done=committed,
+    )
+    # Waits for the commit so constraint errors reach the caller. Shielded so cancelling the caller doesn't cancel the
+    # write.
+    await asyncio.shield(asyncio.wrap_future(future))
+
+
+def update_member(member_id: int, **values):
+    """
+    Update columns of a member
+
+    :param member_id: Member (instance) ID
+    :param values: Column values to set. proxy_tags replaces all proxy tags with the given (prefix, suffix) pairs.
+    """
+    member = _members.get(member_id)
+    if member is None:
+        return
+    columns = {column: value for column, value in values.items() if column != "proxy_tags"}
+    for column in columns:
+        if column not in MEMBER_COLUMNS:
+            raise ValueError(f"Unknown member column {column}")
+    statements = []
+    if columns:
+        statements.append((
+            f"UPDATE members SET {', '.join(f'{column} = ?' for column in columns)} WHERE id = ?",
+            [*columns.values(), member_id],
+        ))
+    if "id" in values:
+        for table in ("proxy_tags", "sync_state", "profile_edits", "pending_profile_edits"):
+            statements.append((f"UPDATE {table} SET member_id = ? WHERE member_id = ?", [values["id"], member_id]))
+    if "proxy_tags" in values:
+        values["proxy_tags"] = tuple(values["proxy_tags"])
+        new_id = values.get("id", member_id)
+        statements.append(("DELETE FROM proxy_tags WHERE member_id = ?", [new_id]))
+        statements.append(_insert_proxy_tags(new_id, values["proxy_tags"]))
+    ids = {member_id, values.get("id", member_id)}
+    _write(*statements, on_done=_reload_on_failure(functools.partial(_reload_members, *ids)))
+    _unindex_member(member)
+    updated = {**member, **values}
+    _index_member(updated)
+    _notify_system(member["main_account_id"])
+    if updated["main_account_id"] != member["main_account_id"]:
+        _notify_system(updated["main_account_id"])
+
+
+def delete_member(id: int):
+    """
+    Delete a member
+
+    :param id: Member (instance) ID
+    """
+    _write(
+        ("DELETE FROM members WHERE id = ?", [id]),
+        ("DELETE FROM proxy_tags WHERE member_id = ?", [id]),
+        ("DELETE FROM sync_state WHERE member_id = ?", [id]),
+        ("DELETE FROM pending_profile_edits WHERE member_id = ?", [id]),
+        on_done=_reload_on_failure(functools.partial(_reload_members, id)),
+    )
+    member = _members.get(id)
+    if member is not None:
+        _unindex_member(member)
+        _notify_system(member["main_account_id"])
+
+
+async def get_tag_conflicts(main_account_id: int) -> List[dict]:
+    """
+    Find proxy tags shared by more than one enabled member of a system
+
+    :param main_account_id: Main account ID of the system
+    :return: Rows of prefix, suffix, member_id and other_id (member_id < other_id)
+    """
+    return await fetch(
+        """
+        SELECT a.prefix, a.suffix, a.member_id, b.member_id AS other_id
+        FROM members AS ma
+        JOIN proxy_tags AS a ON a.member_id = ma.id
+        JOIN proxy_tags AS b ON b.prefix = a.prefix AND b.suffix = a.suffix AND b.member_id > a.member_id
+        JOIN members AS mb ON mb.id = b.member_id
+        WHERE ma.main_account_id = ? AND ma.member_enabled AND mb.main_account_id = ma.main_account_id
+            AND mb.member_enabled
+        ORDER BY a.member_id, b.member_id
+        """,
+        [main_account_id],
+    )
+
+
+def insert_user(id: int):
+    log.debug(f"Inserting user {id} into database...")
+    _write(
+        ("INSERT INTO users VALUES (?, NULL, NULL)", [id]),
+        on_done=_reload_on_failure(functools.partial(_reload_users, id)),
+    )
+    _users[id] = {"id": id, "autoproxy_mode": None, "autoproxy": None}
+
+
+def update_user(user_id: int, **values):
+    """
+    Update columns of a user
+
+    :param user_id: Main account ID
+    :param values: Column values to set
+    """
+    user = _users.get(user_id)
+    if user is None:
+        return
+    for column in values:
+        if column not in USER_COLUMNS:
+            raise ValueError(f"Unknown user column {column}")
+    if "autoproxy" in values:
+        _pending_latches.pop(user_id, None)  # Must not overwrite this write when flushed later
+    _write(
+        (
+            f"UPDATE users SET {', '.join(f'{column} = ?' for column in values)} WHERE id = ?",
+            [*values.values(), user_id],
+        ),
+        on_done=_reload_on_failure(functools.partial(_reload_users, user_id)),
+    )
+    _users[user_id] = {**user, **values}
+
+
+def delete_user(id: int):
+    _pending_latches.pop(id, None)
+    _write(
+        ("DELETE FROM users WHERE id = ?", [id]),
+        on_done=_reload_on_failure(functools.partial(_reload_users, id)),
+    )
+    _users.pop(id, None)
+
+
+# Autoproxy latches
+#
+# The latched member changes on most messages of users in latch mode. The in-memory user row is the source of truth,
+# and changes are written in one batch per flush interval, so at most one interval of latch changes is lost on a crash.
+
+_pending_latches: Dict[int, int] = {}  # Main account ID -> latched member ID not yet written
+_latch_timer: Optional[asyncio.TimerHandle] = None
+
+
+def set_autoproxy_latch(user_id: int, member_id: int):
+    """
+    Latch autoproxy to a member, writing it to the database with the next flush
+
+    :param user_id: Main account ID
+    :param member_id: Member (instance) ID
+    """
+    global _latch_timer
+    user = _users.get(user_id)
+    if user is None or user["autoproxy"] == member_id:
+        return
+    log.debug(f"Setting autoproxy latch of {user_id} to {member_id}")
+    _users[user_id] = {**user, "autoproxy": member_id}
+    _pending_latches[user_id] = member_id
+    if _latch_timer is None:
+        _latch_timer = asyncio.get_event_loop().call_later(AUTOPROXY_FLUSH_INTERVAL, flush_autoproxy_latches)
+
+
+def flush_autoproxy_latches():
+    """Write all pending autoproxy latch changes in one transaction"""
+    global _latch_timer
+    if _latch_timer is not None:
+        _latch_timer.cancel()
+        _latch_timer = None
+    if not _pending_latches:
+        return
+    log.debug(f"Writing {len(_pending_latches)} autoproxy latch change(s)")
+    _write(
+        *[
+            ("UPDATE users SET autoproxy = ? WHERE id = ?", [member_id, user_id])
+            for user_id, member_id in _pending_latches.items()
         ],
+        on_done=_reload_on_failure(functools.partial(_reload_users, *_pending_latches)),
     )
-    conn.commit()
+    _pending_latches.clear()
+
+
+def insert_token(token: str, used: bool):
+    _write(
+        ("INSERT INTO tokens VALUES(?, ?)", [token, used]),
+        on_done=_reload_on_failure(functools.partial(_reload_token, token)),
+    )
+    _tokens[token] = {"token": token, "used": int(used)}
+    _notify_token(token)
+
+
+def update_token(token: str, used: bool):
+    _write(
+        ("UPDATE tokens SET used = ? WHERE token = ?", [used, token]),
+        on_done=_reload_on_failure(functools.partial(_reload_token, token)),
+    )
+    if token in _tokens:
+        _tokens[token] = {"token": token, "used": int(used)}
+        _notify_token(token)
+
+
+# Emote cache persistence
+
+
+async def get_cached_emotes() -> List[dict]:
+    return await fetch("SELECT * FROM emote_cache")
+
+
+def upsert_cached_emote(source_id: int, cached_id: int, name: str, animated: bool, last_used: float, uses: int):
+    _write((
+        "INSERT OR REPLACE INTO emote_cache VALUES(?, ?, ?, ?, ?, ?)",
+        [source_id, cached_id, name, animated, last_used, uses],
+    ))
+
+
+def touch_cached_emote(source_id: int, last_used: float, uses: int):
+    _write((
+        "UPDATE emote_cache SET last_used = ?, uses = ? WHERE source_id = ?",
+        [last_used, uses, source_id],
+    ))
+
+
+def delete_cached_emote(source_id: int):
+    _write(("DELETE FROM emote_cache WHERE source_id = ?", [source_id]))
+
+
+# Applied sync state
+
+SYNC_STATE_COLUMNS = ("member_id", "username", "avatar_url", "avatar_digest", "nickname", "roles")
+
+
+async def get_sync_state(member_id: int) -> Optional[dict]:
+    """
+    Get what the last sync applied to an instance
+
+    :param member_id: Member (instance) ID
+    """
+    rows = await fetch("SELECT * FROM sync_state WHERE member_id = ?", [member_id])
+    return rows[0] if rows else None
+
+
+def update_sync_state(member_id: int, **values):
+    """
+    Record values applied to an instance by a sync
+
+    :param member_id: Member (instance) ID
+    :param values: Column values to set
+    """
+    for column in values:
+        if column not in SYNC_STATE_COLUMNS[1:]:
+            raise ValueError(f"Unknown sync state column {column}")
+    _write(
+        ("INSERT OR IGNORE INTO sync_state (member_id) VALUES (?)", [member_id]),
+        (
+            f"UPDATE sync_state SET {', '.join(f'{column} = ?' for column in values)} WHERE member_id = ?",
+            [*values.values(), member_id],
+        ),
+    )
+
+
+# Profile edit history
+
+
+def insert_profile_edit(member_id: int, kind: str, edited_at: float, prune_before: float):
+    """
+    Record a profile edit and drop history older than prune_before
+
+    :param member_id: Member (instance) ID
+    :param kind: "username" or "avatar"
+    :param edited_at: Unix timestamp
+    :param prune_before: Unix timestamp
+    """
+    _write(
+        ("INSERT INTO profile_edits VALUES (?, ?, ?)", [member_id, kind, edited_at]),
+        ("DELETE FROM profile_edits WHERE edited_at < ?", [prune_before]),
+    )
+
+
+async def get_profile_edits(member_id: int, kind: str, since: float) -> List[float]:
+    """
+    Get the times of recent profile edits, oldest first
+
+    :param member_id: Member (instance) ID
+    :param kind: "username" or "avatar"
+    :param since: Unix timestamp
+    """
+    return [
+        row["edited_at"]
+        for row in await fetch(
+            "SELECT edited_at FROM profile_edits WHERE member_id = ? AND kind = ? AND edited_at >= ? ORDER BY edited_at",
+            [member_id, kind, since],
+        )
+    ]
+
+
+def upsert_pending_profile_edit(member_id: int, kind: str, value: str, queued_at: float):
+    _write((
+        "INSERT OR REPLACE INTO pending_profile_edits VALUES (?, ?, ?, ?)",
+        [member_id, kind, value, queued_at],
+    ))
+
+
+async def get_pending_profile_edits() -> List[dict]:
+    return await fetch("SELECT * FROM pending_profile_edits ORDER BY queued_at")
+
+
+def delete_pending_profile_edit(member_id: int, kind: str):
+    _write(("DELETE FROM pending_profile_edits WHERE member_id = ? AND kind = ?", [member_id, kind]))
@@ -0,0 +1,186 @@
+"""
+Persistent emote cache.
+
+Instances can't use emoji from servers they aren't in, so those emoji are uploaded to the guild and kept in its spare
+emoji slots. The source -> cached emoji mapping is stored in the database so it survives restarts. When the guild runs
+out of spare slots, the least recently used cached emoji is evicted.
+"""
+import asyncio
+import logging
+import re
+import time
+from typing import Dict, List, Optional, Set
+
+import aiohttp
+import discord
+
+from polyphony.helpers.database import (
+    get_cached_emotes,
+    upsert_cached_emote,
+    touch_cached_emote,
+    delete_cached_emote,
+)
+from polyphony.helpers.http import get_session
+from polyphony.settings import EMOTE_CACHE_RESERVED_SLOTS, EMOTE_FETCH_TIMEOUT
+
+log = logging.getLogger(__name__)
+
+EMOTE_PATTERN = re.compile(r"<(?P<animated>a?):(?P<name>\w+):(?P<id>\d+)>")
+
+# Cached emoji used more recently than this are never evicted, since a message using them may still be in flight
+EVICTION_GRACE_SECONDS = 60
+
+# Discord rejects emoji images larger than this
+MAX_EMOJI_SIZE = 256 * 1024
+
+
+class CachedEmote:
+    __slots__ = ("source_id", "cached_id", "name", "animated", "last_used", "uses")
+
+    def __init__(self, source_id: int, cached_id: int, name: str, animated: bool, last_used: float, uses: int):
+        self.source_id = source_id
+        self.cached_id = cached_id
+        self.name = name
+        self.animated = bool(animated)
+        self.last_used = last_used
+        self.uses = uses
+
+    @property
+    def text(self) -> str:
+        return f'<{"a" if self.animated else ""}:{self.name}:{self.cached_id}>'
+
+
+async def fetch_emote_image(emote_id: int, animated: bool) -> bytes:
+    url = f'https://cdn.discordapp.com/emojis/{emote_id}.{"gif" if animated else "webp"}'
+    async with get_session().get(url, timeout=aiohttp.ClientTimeout(total=EMOTE_FETCH_TIMEOUT)) as response:
+        response.raise_for_status()
+        return await response.read()
+
+
+class EmoteCache:
+    def __init__(self):
+        self.entries: Dict[int, CachedEmote] = {}  # Source emoji ID -> cached emoji
+        self.guild_emoji_ids: Set[int] = set()  # Emoji usable without caching
+        self.upload_lock = asyncio.Lock()
+
+    async def load(self):
+        self.entries = {row["source_id"]: CachedEmote(**row) for row in await get_cached_emotes()}
+        log.debug(f"Loaded {len(self.entries)} cached emotes")
+
+    async def reconcile(self, guild: discord.Guild, bot_user_id: int):
+        """
+        Sync the cache with the guild on startup
+
+        Forgets cached emoji that were deleted from the guild and deletes emoji uploaded by Polyphony that are no
+        longer in the cache (e.g. left over from a crash mid-upload).
+        """
+        await self.load()
+        guild_emojis = await guild.fetch_emojis()
+        self.guild_emoji_ids = {e.id for e in guild_emojis}
+        for entry in list(self.entries.values()):
+            if entry.cached_id not in self.guild_emoji_ids:
+                self._forget(entry)
+        cached_ids = {entry.cached_id for entry in self.entries.values()}
+        for emote in guild_emojis:
+            if emote.id not in cached_ids and emote.user is not None and emote.user.id == bot_user_id:
+                log.debug(f"Deleting orphaned emote cache emoji {emote.id} (:{emote.name}:)")
+                await emote.delete()
+                self.guild_emoji_ids.discard(emote.id)
+
+    def is_available(self, emoji_id: int) -> bool:
+        """Check if an emoji is in the guild and can be used as is"""
+        return emoji_id in self.guild_emoji_ids
+
+    async def get(self, guild: discord.Guild, source_id: int, name: str, animated: bool) -> Optional[str]:
+        """
+        Get the text of a usable copy of an emoji, uploading it to the guild if it isn't cached
+
+        :param guild: Guild to cache emoji in
+        :param source_id: ID of the emoji to copy
+        :param name: Emoji name
+        :param animated: Whether the emoji is animated
+        :return: Emoji text or None if there is no room to cache it
+        """
+        entry = self.entries.get(source_id)
+        if entry is None:
+            async with self.upload_lock:
+                # A concurrent message may have uploaded the same emoji while waiting
+                entry = self.entries.get(source_id)
+                if entry is None:
+                    entry = await self._upload(guild, source_id, name, animated)
+                    if entry is None:
+                        return None
+        entry.last_used = time.time()
+        entry.uses += 1
+        touch_cached_emote(entry.source_id, entry.last_used, entry.uses)
+        return entry.text
+
+    def emojis_updated(self, before, after):
+        """Track the guild's emoji and forget cached emoji that were deleted (e.g. by a moderator)"""
+        self.guild_emoji_ids = {e.id for e in after}
+        removed = {e.id for e in before} - self.guild_emoji_ids
+        for entry in list(self.entries.values()):
+            if entry.cached_id in removed:
+                log.debug(f"Cached emote {entry.cached_id} (:{entry.name}:) was removed from the guild")
+                self._forget(entry)
+
+    def _forget(self, entry: CachedEmote):
+        self.entries.pop(entry.source_id, None)
+        delete_cached_emote(entry.source_id)
+
+    def _victims(self, guild: discord.Guild, animated: bool) -> Optional[List[CachedEmote]]:
+        """
+        Pick the cached emoji to evict to make room for one more
+
+        :return: Least recently used emoji to evict (empty if there is a free slot) or None if there is no room
+        """
+        # Static and animated emoji have separate slot limits (only counted when the guild is full, which is rare)
+        used = sum(1 for e in guild.emojis if e.animated == animated)
+        needed = used + EMOTE_CACHE_RESERVED_SLOTS - guild.emoji_limit + 1
+        if needed <= 0:
+            return []
+        candidates = sorted(
+            (
+                e for e in self.entries.values()
+                if e.animated == animated and time.time() - e.last_used > EVICTION_GRACE_SECONDS
+            ),
+            key=lambda e: e.last_used,
+        )
+        if len(candidates) < needed:
+            log.debug(f"No {'animated ' if animated else ''}emote cache slots available")
+            return None
+        return candidates[:needed]
+
+    async def _evict(self, guild: discord.Guild, victim: CachedEmote):
+        log.debug(f"Evicting cached emote {victim.cached_id} (:{victim.name}:)")
+        emoji = discord.utils.get(guild.emojis, id=victim.cached_id)
+        if emoji is not None:
+            await emoji.delete()
+        self.guild_emoji_ids.discard(victim.cached_id)
+        self._forget(victim)
+
+    async def _upload(self, guild: discord.Guild, source_id: int, name: str, animated: bool) -> Optional[CachedEmote]:
+        if self._victims(guild, animated) is None:
+            return None
+        log.debug(f'Getting emote image {source_id} (:{name}:)')
+        image = await fetch_emote_image(source_id, animated)
+        if len(image) > MAX_EMOJI_SIZE:
+            log.debug(f"Emote {source_id} (:{name}:) is too large to upload ({len(image)} bytes)")
+            return None
+        # Cached emoji are only evicted once the new one is ready to upload, so a failed download doesn't cost a slot.
+        # Victims are picked again since cached emoji may have been used while downloading.
+        victims = self._victims(guild, animated)
+        if victims is None:
+            return None
+        for victim in victims:
+            await self._evict(guild, victim)
+        log.debug(f'Uploading emote {source_id} (:{name}:)')
+        cached = await guild.create_custom_emoji(name=name, image=image)
+        self.guild_emoji_ids.add(cached.id)
+        entry = CachedEmote(source_id, cached.id, cached.name, animated, time.time(), 0)
+        self.entries[source_id] = entry
+        upsert_cached_emote(entry.source_id, entry.cached_id, entry.name, entry.animated, entry.last_used, entry.uses)
+        log.debug(f'{source_id} (:{name}:) cached as {cached.id}')
+        return entry
+
+persistent_emotes = EmoteCache()
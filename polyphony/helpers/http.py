@@ -0,0 +1,35 @@
+"""
+Shared pooled HTTP client for requests that don't go through the Discord API client.
+"""
+import logging
+from typing import Optional
+
+import aiohttp
+
+from polyphony.settings import HTTP_POOL_SIZE
+
+log = logging.getLogger(__name__)
+
+_session: Optional[aiohttp.ClientSession] = None
+
+
+def get_session() -> aiohttp.ClientSession:
+    """
+    Get the shared keep-alive session, creating it on first use
+
+    Must be called from within the event loop.
+    """
+    global _session
+    if _session is None or _session.closed:
+        log.debug("Opening shared HTTP session")
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=HTTP_POOL_SIZE),
+        )
+    return _session
+
+
+async def close_session():
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
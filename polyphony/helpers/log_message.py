@@ -1,52 +1,250 @@
+import asyncio
+import bisect
 import logging
+import time
+from typing import List, Optional, Tuple
 
 import discord
 from discord.ext import commands
 
+from polyphony.settings import LOG_MESSAGE_FLUSH_INTERVAL
+
 log = logging.getLogger(__name__)
 
+# Edits merged into a later edit across all log messages, for diagnostics
+suppressed_edits_total = 0
+
+# Maximum length of an embed description
+DESCRIPTION_LIMIT = 2048
+
 # TODO: Add comments
 # TODO: Reimplement usages using new features
 
 
+class _Lines(list):
+    """Content lines that keep track of their lengths and of which lines changed since the last render"""
+
+    def __init__(self, lines=()):
+        super().__init__(lines)
+        self.lengths: List[int] = [len(line) for line in self]
+        self.changed = set()
+        self.resized = True  # Lines were inserted or removed somewhere other than the end
+
+    def _reset(self):
+        self.lengths = [len(line) for line in self]
+        self.resized = True
+
+    def __setitem__(self, index, value):
+        super().__setitem__(index, value)
+        if isinstance(index, slice):
+            self._reset()
+        else:
+            index = index % len(self)
+            self.lengths[index] = len(value)
+            self.changed.add(index)
+
+    def append(self, value):
+        super().append(value)
+        self.lengths.append(len(value))
+        self.changed.add(len(self) - 1)
+
+    def extend(self, values):
+        for value in values:
+            self.append(value)
+
+    def __delitem__(self, index):
+        super().__delitem__(index)
+        self._reset()
+
+    def insert(self, index, value):
+        super().insert(index, value)
+        self._reset()
+
+    def pop(self, index=-1):
+        value = super().pop(index)
+        self._reset()
+        return value
+
+    def remove(self, value):
+        super().remove(value)
+        self._reset()
+
+    def clear(self):
+        super().clear()
+        self._reset()
+
+
+class _Page:
+    __slots__ = ("message", "start", "end")
+
+    def __init__(self, message: discord.Message):
+        self.message = message
+        self.start: Optional[int] = None  # Line range shown in the message, None if it shows something else
+        self.end: Optional[int] = None
+
+
 class LogMessage:
-    def __init__(self, ctx: commands.Context, title="Loading..."):
-        self.message = None
+    """
+    Embed that shows the progress of a long running command
+
+    Changes are rendered at most once per flush interval. Changes made in between are merged into the next edit.
+    Content that doesn't fit in one embed is split over several messages, and only messages with changed lines are
+    edited.
+    """
+
+    def __init__(self, ctx: commands.Context, title="Loading...", flush_interval: float = LOG_MESSAGE_FLUSH_INTERVAL):
         self.ctx = ctx
         self.title = title
         self.color = discord.Color.orange()
-        self.content = []
-        self.batches = []
+        self._content = _Lines()
+        self.pages: List[_Page] = []
+        self.rendered_title = None
+        self.rendered_color = None
+        self.flush_interval = flush_interval
+        self.dirty = False
+        self.last_flush = 0.0
+        self.flush_task = None
+        self.flush_lock = asyncio.Lock()
+        self.suppressed_edits = 0
+
+    @property
+    def content(self) -> List[str]:
+        return self._content
+
+    @content.setter
+    def content(self, lines: List[str]):
+        self._content = _Lines(lines)
+
+    @property
+    def message(self) -> Optional[discord.Message]:
+        """Last message of the log"""
+        return self.pages[-1].message if self.pages else None
 
     async def init(self):
         log.debug("Creating LogMessage Instance...")
         await self.send("One sec...")
         log.debug("LogMessage Instance Created.")
 
+    def _embed(self, page_index: int, description: str) -> discord.Embed:
+        if page_index == 0:
+            return discord.Embed(title=self.title, description=description, color=self.color)
+        return discord.Embed(description=description, color=self.color)
+
     async def send(self, content):
-        if len(self.batches) > 0:
-            embed = discord.Embed(description=content, color=self.color)
-        else:
-            embed = discord.Embed(
-                title=self.title, description=content, color=self.color
-            )
-        if self.message is None:
-            self.message = await self.ctx.send(embed=embed)
-        elif len("\n".join(self.content)) >= 2048:
-            self.batches.append([self.message, self.content[:-1]])
-            self.content = self.content[-1:]
-            embed = discord.Embed(description="\n".join(self.content), color=self.color)
-            self.message = await self.ctx.send(embed=embed)
-        else:
-            await self.message.edit(embed=embed)
+        """Show content in the last message right away, replacing any pending changes"""
+        self._cancel_flush()
+        self.dirty = False
+        self.last_flush = time.monotonic()
+        async with self.flush_lock:
+            try:
+                if not self.pages:
+                    self.pages.append(_Page(await self.ctx.send(embed=self._embed(0, content))))
+                else:
+                    page = self.pages[-1]
+                    await page.message.edit(embed=self._embed(len(self.pages) - 1, content))
+                    page.start = page.end = None
+            except discord.NotFound:
+                log.debug("LogMessage was deleted before it could be updated")
+
+    def _layout(self) -> List[Tuple[int, int]]:
+        """Split lines into pages that fit in an embed description"""
+        pages = []
+        start = 0
+        size = 0
+        for i, length in enumerate(self._content.lengths):
+            length = min(length, DESCRIPTION_LIMIT)
+            if i > start and size + 1 + length > DESCRIPTION_LIMIT:
+                pages.append((start, i))
+                start = i
+                size = length
+            else:
+                size += length + (1 if i > start else 0)
+        pages.append((start, len(self._content)))
+        return pages
+
+    async def _render(self):
+        lines = self._content
+        layout = self._layout()
+        starts = [start for start, _ in layout]
+        changed_pages = {bisect.bisect_right(starts, i) - 1 for i in lines.changed}
+        if self.rendered_title != self.title:
+            changed_pages.add(0)
+        # Re-render every page if the color changed or lines were inserted or removed
+        rerender = self.rendered_color != self.color or lines.resized
+        lines.changed = set()
+        lines.resized = False
+        self.rendered_title = self.title
+        self.rendered_color = self.color
+
+        for page_index, (start, end) in enumerate(layout):
+            if page_index < len(self.pages):
+                page = self.pages[page_index]
+                if not rerender and page_index not in changed_pages and (page.start, page.end) == (start, end):
+                    continue
+            else:
+                page = None
+            description = "\n".join(line[:DESCRIPTION_LIMIT] for line in lines[start:end])
+            embed = self._embed(page_index, description)
+            if page is None:
+                page = _Page(await self.ctx.send(embed=embed))
+                self.pages.append(page)
+            else:
+                await page.message.edit(embed=embed)
+            page.start, page.end = start, end
+
+        # Content shrank, so later messages are no longer needed
+        for page in self.pages[len(layout):]:
+            await page.message.delete()
+        del self.pages[len(layout):]
 
     async def log(self, message):
         log.debug(f"LogMessage: {message}")
         self.content.append(message)
-        await self.send("\n".join(self.content))
+        await self.update()
 
     async def update(self):
-        await self.send("\n".join(self.content))
+        """Schedule a render of the current content"""
+        global suppressed_edits_total
+        if self.dirty:
+            self.suppressed_edits += 1
+            suppressed_edits_total += 1
+            return
+        self.dirty = True
+        delay = self.last_flush + self.flush_interval - time.monotonic()
+        if delay <= 0:
+            await self.flush()
+        else:
+            self.flush_task = asyncio.ensure_future(self._flush_later(delay))
+
+    async def _flush_later(self, delay: float):
+        await asyncio.sleep(delay)
+        self.flush_task = None
+        await self.flush()
+
+    def _cancel_flush(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+
+    async def flush(self):
+        """Render pending changes now"""
+        if not self.dirty:
+            return
+        self._cancel_flush()
+        self.dirty = False
+        self.last_flush = time.monotonic()
+        async with self.flush_lock:
+            try:
+                await self._render()
+            except discord.NotFound:
+                log.debug("LogMessage was deleted before it could be updated")
+
+    async def delete(self):
+        self._cancel_flush()
+        self.dirty = False
+        for page in self.pages:
+            await page.message.delete()
+        self.pages = []
 
     async def edit(self, index, content):
         self.content[index] = content
@@ -57,16 +255,5 @@ class LogMessage:
             self.title = title
         if color:
             self.color = color
-        await self.update()
-
-        if self.batches:
-            embed = discord.Embed(
-                title=self.title,
-                description="\n".join(self.batches[0][1]),
-                color=self.color,
-            )
-            await self.batches[0][0].edit(embed=embed)
-
-            for message, content in self.batches[1:]:
-                embed = discord.Embed(description="\n".join(content), color=self.color)
-                await message.edit(embed=embed)
+        self.dirty = True
+        await self.flush()
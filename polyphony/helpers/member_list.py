@@ -1,5 +1,3 @@
-import json
-import sqlite3
 from typing import List
 
 import discord
@@ -7,7 +5,7 @@ from discord.ext import commands
 
 
 async def send_member_list(
-    ctx: commands.context, embed, member_list: List[sqlite3.Row], whoarewe=False
+    ctx: commands.context, embed, member_list: List[dict], whoarewe=False
 ):
     if member_list is None:
         embed.add_field(name="No members where found")
@@ -18,15 +16,7 @@ async def send_member_list(
             embed = discord.Embed()
         member_user = ctx.guild.get_member(member["id"])
         owner_user = ctx.guild.get_member(member["main_account_id"])
-        tags = []
-        for tag in json.loads(member["pk_proxy_tags"]):
-            tags.append(
-                "`"
-                + (tag.get("prefix") or "")
-                + "text"
-                + (tag.get("suffix") or "")
-                + "`"
-            )
+        tags = [f"`{prefix}text{suffix}`" for prefix, suffix in member["proxy_tags"]]
         if whoarewe:
             embed.add_field(
                 name=member["member_name"],
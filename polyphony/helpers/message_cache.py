@@ -5,7 +5,7 @@ import discord
 
 log = logging.getLogger(__name__)
 
-recently_proxied_messages = collections.deque(maxlen=1)
+recently_proxied_messages = collections.deque(maxlen=100)  # Originals are deleted in batches
 
 
 def new_proxied_message(oldmsg: discord.Message):
@@ -0,0 +1,143 @@
+"""
+Per-channel ordered outbox for proxied messages.
+
+Each channel gets a bounded FIFO queue drained by its own worker, so messages in a channel are proxied in order while
+channels progress independently. Originals are deleted in batches once their proxies have landed.
+"""
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import discord
+
+from polyphony.settings import OUTBOX_MAX_SIZE, OUTBOX_FULL_POLICY
+
+log = logging.getLogger(__name__)
+
+# Discord bulk delete accepts at most 100 messages
+DELETE_BATCH_MAX = 100
+
+
+class OutboxJob:
+    __slots__ = ("message", "send", "queued_at")
+
+    def __init__(self, message: discord.Message, send: Callable[[], Awaitable[bool]]):
+        self.message = message  # Original message, deleted once the proxy has landed
+        self.send = send  # Returns True once the proxied message was sent
+        self.queued_at = time.monotonic()
+
+
+class Outbox:
+    def __init__(
+        self,
+        max_size: int = OUTBOX_MAX_SIZE,
+        policy: str = OUTBOX_FULL_POLICY,
+        on_proxied: Optional[Callable[[discord.Message], None]] = None,
+    ):
+        """
+        :param max_size: Maximum number of queued messages per channel
+        :param policy: What to do when a channel queue is full. "wait" holds the new message until there is room,
+                       "reject" leaves it unproxied.
+        :param on_proxied: Called with each original message right before it is deleted
+        """
+        if policy not in ("wait", "reject"):
+            raise ValueError(f"Unknown outbox policy {policy}")
+        self.max_size = max_size
+        self.policy = policy
+        self.on_proxied = on_proxied
+        self.queues: Dict[int, asyncio.Queue] = {}
+        self.workers: Dict[int, asyncio.Task] = {}
+        self.pending_deletes: Dict[int, List[discord.Message]] = {}
+
+        # Monitoring
+        self.sent = 0
+        self.failed = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    async def submit(self, message: discord.Message, send: Callable[[], Awaitable[bool]]) -> bool:
+        """
+        Queue a proxied message behind earlier messages in the same channel
+
+        Must be called before the caller awaits anything else, otherwise ordering within the channel is lost.
+
+        :param message: Original message
+        :param send: Coroutine function that sends the proxied message
+        :return: False if the message was rejected because the channel queue is full
+        """
+        channel_id = message.channel.id
+        queue = self.queues.get(channel_id)
+        if queue is None:
+            queue = self.queues[channel_id] = asyncio.Queue(self.max_size)
+
+        if queue.full():
+            if self.policy == "reject":
+                self.rejected += 1
+                log.warning(
+                    f"Outbox for channel {channel_id} is full ({queue.qsize()} queued). Message {message.id} was not proxied."
+                )
+                return False
+            log.debug(f"Outbox for channel {channel_id} is full. Waiting for room...")
+
+        await queue.put(OutboxJob(message, send))
+        if channel_id not in self.workers:
+            self.workers[channel_id] = asyncio.create_task(self._worker(channel_id, queue))
+        return True
+
+    async def _worker(self, channel_id: int, queue: asyncio.Queue):
+        try:
+            while not queue.empty():
+                job = queue.get_nowait()
+                wait = time.monotonic() - job.queued_at
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+
+                try:
+                    sent = await job.send()
+                except Exception as e:
+                    log.exception(e)
+                    sent = False
+
+                if sent:
+                    self.sent += 1
+                    self.pending_deletes.setdefault(channel_id, []).append(job.message)
+                else:
+                    self.failed += 1
+
+                if queue.empty() or len(self.pending_deletes.get(channel_id, [])) >= DELETE_BATCH_MAX:
+                    await self._flush_deletes(channel_id)
+        finally:
+            # The queue is empty and nothing was awaited since checking, so no job can be stranded
+            del self.workers[channel_id]
+
+    async def _flush_deletes(self, channel_id: int):
+        messages = self.pending_deletes.pop(channel_id, [])
+        if not messages:
+            return
+        if self.on_proxied is not None:
+            for message in messages:
+                self.on_proxied(message)
+        try:
+            if len(messages) == 1:
+                await messages[0].delete()
+            else:
+                await messages[0].channel.delete_messages(messages)
+            log.debug(f"Deleted {len(messages)} proxied message(s) in channel {channel_id}")
+        except discord.HTTPException as e:
+            log.warning(f"Failed to delete {len(messages)} proxied message(s) in channel {channel_id}: {e}")
+
+    def stats(self) -> dict:
+        depths = {channel_id: queue.qsize() for channel_id, queue in self.queues.items() if queue.qsize()}
+        processed = self.sent + self.failed
+        return {
+            "queued": sum(depths.values()),
+            "max_channel_depth": max(depths.values(), default=0),
+            "active_channels": len(self.workers),
+            "sent": self.sent,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "avg_wait_seconds": round(self.total_wait / processed, 3) if processed else 0.0,
+            "max_wait_seconds": round(self.max_wait, 3),
+        }
@@ -1,59 +1,202 @@
 """
 Functions that pull data from the PluralKit API.
+
+Requests go through the shared HTTP session with a per-request timeout and a cap on concurrent requests. Rate limited
+requests (429) are retried after the delay PluralKit asks for.
+
+Responses are cached per endpoint. Entries younger than their TTL are served from memory, older ones are revalidated
+with a conditional request (ETag/Last-Modified) and concurrent lookups of the same endpoint share one request.
 """
+import asyncio
 import logging
-from typing import Union, List
-from urllib import request, error
-import json
+import time
+from typing import Dict, Union, List, Optional
+
+import aiohttp
+
+from polyphony.helpers.http import get_session
+from polyphony.settings import (
+    PK_MAX_CONCURRENCY,
+    PK_MEMBER_CACHE_TTL,
+    PK_REQUEST_TIMEOUT,
+    PK_SYSTEM_CACHE_TTL,
+)
 
 log = logging.getLogger(__name__)
 
+PK_API_URL = "https://api.pluralkit.me/v2"
+
+# Attempts per request when PluralKit keeps responding with 429
+MAX_ATTEMPTS = 3
+
+_semaphore: Optional[asyncio.Semaphore] = None
+
+
+class PKCacheEntry:
+    __slots__ = ("data", "etag", "last_modified", "fetched_at")
+
+    def __init__(self, data, etag: Optional[str], last_modified: Optional[str]):
+        self.data = data
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched_at = time.monotonic()
+
+    @property
+    def age(self) -> float:
+        """Seconds since the data was last confirmed by PluralKit"""
+        return time.monotonic() - self.fetched_at
+
+
+_cache: Dict[str, PKCacheEntry] = {}  # API path -> entry
+_inflight: Dict[str, asyncio.Future] = {}  # API path -> pending request
+cache_hits = 0
+cache_revalidations = 0  # Conditional requests answered with 304 Not Modified
+cache_misses = 0
+rate_limited = 0  # 429 responses, also used by the sync scheduler to back off
+
+
+def _get_semaphore() -> asyncio.Semaphore:
+    # Created lazily so it belongs to the running event loop
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(PK_MAX_CONCURRENCY)
+    return _semaphore
+
+
+def _retry_after(response: aiohttp.ClientResponse) -> float:
+    try:
+        return max(float(response.headers.get("Retry-After", 1)), 0)
+    except ValueError:
+        return 1
+
 
-async def pk_get_system(system_id: str) -> Union[dict, None]:
+async def pk_request(path: str, cached: Optional[PKCacheEntry] = None) -> Optional[PKCacheEntry]:
+    """
+    GET a PluralKit API endpoint
+
+    :param path: Path relative to the API root (e.g. /members/abcde)
+    :param cached: Previous response to revalidate
+    :return: Response (cached itself if it is still valid) or None if the request failed
+    """
+    global rate_limited
+    url = PK_API_URL + path
+    timeout = aiohttp.ClientTimeout(total=PK_REQUEST_TIMEOUT)
+    headers = {}
+    if cached is not None:
+        if cached.etag is not None:
+            headers["If-None-Match"] = cached.etag
+        if cached.last_modified is not None:
+            headers["If-Modified-Since"] = cached.last_modified
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            async with _get_semaphore():
+                async with get_session().get(url, headers=headers, timeout=timeout) as response:
+                    if response.status == 429:
+                        rate_limited += 1
+                        delay = _retry_after(response)
+                    elif response.status == 304 and cached is not None:
+                        cached.fetched_at = time.monotonic()
+                        return cached
+                    else:
+                        response.raise_for_status()
+                        return PKCacheEntry(
+                            await response.json(),
+                            response.headers.get("ETag"),
+                            response.headers.get("Last-Modified"),
+                        )
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            log.debug(f"PluralKit request {path} failed ({e!r})")
+            return None
+        # Sleep outside of the semaphore so other requests can go ahead
+        log.debug(f"PluralKit rate limited {path}, retrying in {delay}s (attempt {attempt + 1} of {MAX_ATTEMPTS})")
+        await asyncio.sleep(delay)
+    log.warning(f"PluralKit request {path} is still rate limited after {MAX_ATTEMPTS} attempts")
+    return None
+
+
+async def _refresh(path: str) -> Optional[PKCacheEntry]:
+    global cache_revalidations, cache_misses
+    cached = _cache.get(path)
+    entry = await pk_request(path, cached)
+    if entry is None:
+        _cache.pop(path, None)
+    elif entry is cached:
+        cache_revalidations += 1
+    else:
+        cache_misses += 1
+        _cache[path] = entry
+    return entry
+
+
+async def pk_get(path: str, ttl: float, max_age: Optional[float] = None) -> Optional[PKCacheEntry]:
+    """
+    Get a PluralKit API endpoint through the cache
+
+    :param path: Path relative to the API root
+    :param ttl: Default maximum age of cached data for this kind of endpoint
+    :param max_age: Maximum acceptable age of cached data in seconds. 0 always revalidates with PluralKit.
+    :return: Cache entry or None if the request failed
+    """
+    global cache_hits
+    max_age = ttl if max_age is None else max_age
+    entry = _cache.get(path)
+    if entry is not None and entry.age < max_age:
+        cache_hits += 1
+        return entry
+
+    future = _inflight.get(path)
+    if future is None:
+        future = _inflight[path] = asyncio.ensure_future(_refresh(path))
+        future.add_done_callback(lambda _: _inflight.pop(path, None))
+    # Shielded so one caller giving up doesn't cancel the request for the others
+    return await asyncio.shield(future)
+
+
+def pk_cache_stats() -> dict:
+    return {
+        "entries": len(_cache),
+        "inflight": len(_inflight),
+        "hits": cache_hits,
+        "revalidated": cache_revalidations,
+        "misses": cache_misses,
+        "rate_limited": rate_limited,
+    }
+
+
+async def pk_get_system(system_id: str, max_age: Optional[float] = None) -> Union[dict, None]:
     """
     Gets a PluralKit system
 
     :param system_id: PluralKit System ID
+    :param max_age: Maximum acceptable age of cached data in seconds (default: PK_SYSTEM_CACHE_TTL)
     :return: (dict) https://app.swaggerhub.com/apis-docs/xSke/PluralKit/1.0#/Systems/GetSystem
     """
     log.debug(f"Getting system {system_id}")
-    try:
-        with request.urlopen(f"https://api.pluralkit.me/v2/system/{system_id}") as url:
-            return json.loads(url.read().decode())
-    except error.URLError as e:
-        log.debug(f"Failed to get system {system_id} ({e})")
-        return None
+    entry = await pk_get(f"/systems/{system_id}", PK_SYSTEM_CACHE_TTL, max_age)
+    return entry.data if entry is not None else None
 
 
-async def pk_get_system_members(system_id: str) -> Union[List[dict], None]:
+async def pk_get_system_members(system_id: str, max_age: Optional[float] = None) -> Union[List[dict], None]:
     """
     Gets all members of a PluralKit system
 
     :param system_id: PluralKit System ID
+    :param max_age: Maximum acceptable age of cached data in seconds (default: PK_MEMBER_CACHE_TTL)
     :return: (dict) https://app.swaggerhub.com/apis-docs/xSke/PluralKit/1.0#/Members/GetSystemMembers
     """
     log.debug(f"Getting system members of {system_id}")
-    try:
-        with request.urlopen(
-            f"https://api.pluralkit.me/v2/system/{system_id}/members"
-        ) as url:
-            return json.loads(url.read().decode())
-    except error.URLError as e:
-        log.debug(f"Failed to get members of system {system_id} ({e})")
-        return None
+    entry = await pk_get(f"/systems/{system_id}/members", PK_MEMBER_CACHE_TTL, max_age)
+    return entry.data if entry is not None else None
 
 
-async def pk_get_member(member_id: str) -> Union[dict, None]:
+async def pk_get_member(member_id: str, max_age: Optional[float] = None) -> Union[dict, None]:
     """
     Get PluralKit member by ID
 
     :param member_id: PluralKit Member ID
+    :param max_age: Maximum acceptable age of cached data in seconds (default: PK_MEMBER_CACHE_TTL)
     :return: (dict) https://app.swaggerhub.com/apis-docs/xSke/PluralKit/1.0#/Members/GetMember
     """
     log.debug(f"Getting member {member_id}")
-    try:
-        with request.urlopen(f"https://api.pluralkit.me/v2/members/{member_id}") as url:
-            return json.loads(url.read().decode())
-    except error.URLError as e:
-        log.debug(f"Failed to get members of system {member_id} ({e})")
-        return None
+    entry = await pk_get(f"/members/{member_id}", PK_MEMBER_CACHE_TTL, max_age)
+    return entry.data if entry is not None else None
@@ -0,0 +1,186 @@
+"""
+Budget scheduler for instance username and avatar edits.
+
+Discord only allows a few profile edits per account in a rolling window. Every edit is recorded in the database, so
+the remaining budget of an instance is known before an edit is attempted. Edits that don't fit in the budget are
+queued (only the latest value per instance and kind is kept) and applied once the budget frees up.
+"""
+import asyncio
+import logging
+import time
+from typing import Dict, Optional, Tuple
+
+import discord
+
+from polyphony.helpers.database import (
+    delete_pending_profile_edit,
+    get_member,
+    get_pending_profile_edits,
+    get_profile_edits,
+    get_sync_state,
+    insert_profile_edit,
+    update_sync_state,
+    upsert_pending_profile_edit,
+)
+
+log = logging.getLogger(__name__)
+
+# Edits allowed per rolling window in seconds
+EDIT_LIMITS: Dict[str, Tuple[int, float]] = {
+    "username": (2, 60 * 60),
+    "avatar": (2, 10 * 60),
+}
+
+# Longest time the drain loop sleeps without being woken up
+MAX_IDLE_SECONDS = 5 * 60
+
+_wakeup: Optional[asyncio.Event] = None
+_task: Optional[asyncio.Task] = None
+
+
+async def next_edit_time(member_id: int, kind: str) -> float:
+    """
+    Get when an instance may next edit its profile
+
+    :param member_id: Member (instance) ID
+    :param kind: "username" or "avatar"
+    :return: Unix timestamp, in the past if there is budget left
+    """
+    limit, window = EDIT_LIMITS[kind]
+    now = time.time()
+    edits = await get_profile_edits(member_id, kind, now - window)
+    if len(edits) < limit:
+        return now
+    return edits[-limit] + window
+
+
+async def record_edit(member_id: int, kind: str, throttled: bool = False):
+    """
+    Record a profile edit attempt that counts against the budget
+
+    :param member_id: Member (instance) ID
+    :param kind: "username" or "avatar"
+    :param throttled: Discord rejected the edit for being too fast, so the whole budget is used up
+    """
+    limit, window = EDIT_LIMITS[kind]
+    now = time.time()
+    longest_window = max(w for _, w in EDIT_LIMITS.values())
+    count = limit - len(await get_profile_edits(member_id, kind, now - window)) if throttled else 1
+    for _ in range(max(count, 1)):
+        insert_profile_edit(member_id, kind, now, now - longest_window)
+
+
+async def defer_edit(member_id: int, kind: str, value: str) -> float:
+    """
+    Queue a profile edit until there is budget for it, replacing any queued edit of the same kind
+
+    :param member_id: Member (instance) ID
+    :param kind: "username" or "avatar"
+    :param value: Username (without prefix) or avatar URL
+    :return: Unix timestamp the edit is expected to be applied at
+    """
+    log.debug(f"Deferring {kind} edit of {member_id}")
+    upsert_pending_profile_edit(member_id, kind, value, time.time())
+    if _wakeup is not None:
+        _wakeup.set()
+    return await next_edit_time(member_id, kind)
+
+
+def edit_applied(member_id: int, kind: str):
+    """
+    Drop a queued edit that was superseded by an edit that was just applied
+
+    :param member_id: Member (instance) ID
+    :param kind: "username" or "avatar"
+    """
+    delete_pending_profile_edit(member_id, kind)
+
+
+def edit_failed(member_id: int, kind: str):
+    """
+    Drop a queued edit that failed for a reason other than the rate limit
+
+    Retrying wouldn't help (the name is taken or the avatar can't be used), so the edit is only tried again by the next sync.
+
+    :param member_id: Member (instance) ID
+    :param kind: "username" or "avatar"
+    """
+    log.debug(f"Dropping failed {kind} edit of {member_id}")
+    delete_pending_profile_edit(member_id, kind)
+
+
+async def drain() -> Optional[float]:
+    """
+    Apply queued edits that fit in their instance's budget
+
+    :return: Unix timestamp of the next queued edit or None if the queue is empty
+    """
+    from polyphony.instance.bot import PolyphonyInstance
+
+    pending: Dict[int, Dict[str, str]] = {}
+    next_due = None
+    for edit in await get_pending_profile_edits():
+        due = await next_edit_time(edit["member_id"], edit["kind"])
+        if due <= time.time():
+            pending.setdefault(edit["member_id"], {})[edit["kind"]] = edit["value"]
+        else:
+            next_due = due if next_due is None else min(next_due, due)
+
+    for member_id, edits in pending.items():
+        member = get_member(member_id)
+        if member is None:
+            for kind in edits:
+                delete_pending_profile_edit(member_id, kind)
+            continue
+
+        instance = PolyphonyInstance(member["pk_member_id"])
+        try:
+            await asyncio.wait_for(instance.login_rest(member["token"]), timeout=10)
+        except discord.LoginFailure:
+            # The token was reset, so the edits can't be applied until the next sync after it is fixed
+            log.info(f"Dropping queued profile edits of {member_id} due to invalid token")
+            await instance.close()
+            for kind in edits:
+                edit_failed(member_id, kind)
+            continue
+        except (asyncio.TimeoutError, discord.HTTPException) as e:
+            log.info(f"Could not apply queued profile edits of {member_id} ({e!r})")
+            await instance.close()
+            continue
+
+        state = await get_sync_state(member_id) or {}
+        if "username" in edits:
+            await instance.update_username(edits["username"])
+            if instance.username_applied(edits["username"]):
+                update_sync_state(member_id, username=edits["username"])
+        if "avatar" in edits:
+            if await instance.update_avatar(edits["avatar"], applied_digest=state.get("avatar_digest")) == 0:
+                update_sync_state(member_id, avatar_url=edits["avatar"], avatar_digest=instance.avatar_digest)
+        await instance.close()
+        log.debug(f"Applied queued profile edits of {instance.user}")
+
+    return next_due
+
+
+async def run():
+    """Apply queued edits whenever budget frees up"""
+    global _wakeup
+    _wakeup = asyncio.Event()
+    while True:
+        _wakeup.clear()
+        try:
+            next_due = await drain()
+        except Exception as e:
+            log.exception(e)
+            next_due = None
+        delay = MAX_IDLE_SECONDS if next_due is None else min(max(next_due - time.time(), 1), MAX_IDLE_SECONDS)
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
+
+
+def start():
+    global _task
+    if _task is None or _task.done():
+        _task = asyncio.ensure_future(run())
@@ -1,132 +1,285 @@
 import asyncio
+import functools
 import json
 import logging
-import sqlite3
-from typing import List, NoReturn
+import time
+from typing import Dict, List, NoReturn, Optional, Tuple
 
 import discord
 from discord.ext import commands
 
-from polyphony.helpers.database import conn
+from polyphony.helpers.database import get_sync_state, normalize_proxy_tags, update_member, update_sync_state
 from polyphony.helpers.log_message import LogMessage
-from polyphony.helpers.pluralkit import pk_get_member
+from polyphony.helpers import pluralkit
+from polyphony.helpers.pluralkit import pk_get_member, pk_get_system_members
 from polyphony.instance.bot import PolyphonyInstance
-from polyphony.settings import SYNC_BATCH_SIZE
+from polyphony.settings import (
+    INSTANCE_ADD_ROLES,
+    INSTANCE_REMOVE_ROLES,
+    SYNC_BATCH_SIZE,
+    SYNC_MAX_CONCURRENCY,
+)
+
+# Instance logins slower than this are treated as a sign of Discord congestion
+SLOW_LOGIN_SECONDS = 5
 
 log = logging.getLogger(__name__)
 
 
+class SyncScheduler:
+    """
+    Bounded worker pool that keeps up to `limit` syncs in flight
+
+    The limit adapts to how the APIs respond: it grows by one after every healthy sync and is halved after a slow or
+    timed out instance login or a PluralKit 429.
+    """
+
+    def __init__(self, initial: int = SYNC_BATCH_SIZE, maximum: int = SYNC_MAX_CONCURRENCY):
+        self.maximum = max(maximum, 1)
+        self.limit = min(max(initial, 1), self.maximum)
+        self.active = 0
+        self.condition = asyncio.Condition()
+        self.pk_rate_limited = pluralkit.rate_limited
+
+    async def acquire(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+
+    async def release(self, login_seconds: Optional[float]):
+        """
+        :param login_seconds: How long the instance took to log in, None if it timed out
+        """
+        async with self.condition:
+            self.active -= 1
+            throttled = pluralkit.rate_limited != self.pk_rate_limited
+            self.pk_rate_limited = pluralkit.rate_limited
+            if throttled or login_seconds is None or login_seconds > SLOW_LOGIN_SECONDS:
+                self.limit = max(self.limit // 2, 1)
+                log.debug(f"Sync concurrency reduced to {self.limit}")
+            elif self.limit < self.maximum:
+                self.limit += 1
+            self.condition.notify_all()
+
+    async def run(self, jobs: list):
+        """
+        Run all jobs through the pool
+
+        :param jobs: Coroutine functions that sync one member and return its login time (None if it timed out)
+        """
+        queue = asyncio.Queue()
+        for job in jobs:
+            queue.put_nowait(job)
+
+        async def worker():
+            while not queue.empty():
+                job = queue.get_nowait()
+                await self.acquire()
+                login_seconds = None
+                try:
+                    login_seconds = await job()
+                except Exception as e:
+                    log.exception(e)
+                finally:
+                    await self.release(login_seconds)
+
+        await asyncio.gather(*[worker() for _ in range(min(self.maximum, len(jobs)))])
+
+
+def default_roles_state() -> str:
+    """:return: Default role settings as stored in the sync state once applied"""
+    return json.dumps([INSTANCE_ADD_ROLES, INSTANCE_REMOVE_ROLES])
+
+
+def group_by_system(query: List[dict]) -> Dict[int, List[str]]:
+    """
+    :param query: Member rows
+    :return: Main account ID -> PluralKit member IDs of the queried members of that system
+    """
+    systems: Dict[int, List[str]] = {}
+    for member in query:
+        systems.setdefault(member["main_account_id"], []).append(member["pk_member_id"])
+    return systems
+
+
+async def fetch_pk_system(
+    main_account_id: int, pk_member_ids: List[str], max_age: Optional[float] = None
+) -> Tuple[Dict[str, Optional[dict]], int]:
+    """
+    Fetch PluralKit members of one system with as few API calls as possible
+
+    A system with more than one queried member is fetched in one call. Members missing from the system list (private
+    members or unlinked accounts) are fetched individually.
+
+    :param main_account_id: Main account ID of the system
+    :param pk_member_ids: PluralKit member IDs to fetch
+    :param max_age: Maximum acceptable age of cached PluralKit data in seconds
+    :return: (PluralKit member ID -> member or None if not found, number of API calls made)
+    """
+    found = {}
+    calls = 0
+    if len(pk_member_ids) > 1:
+        # PluralKit resolves systems by linked Discord account
+        calls += 1
+        for pk_member in await pk_get_system_members(str(main_account_id), max_age=max_age) or []:
+            if pk_member.get("id") in pk_member_ids:
+                found[pk_member["id"]] = pk_member
+    missing = [pk_member_id for pk_member_id in pk_member_ids if pk_member_id not in found]
+    if missing and len(pk_member_ids) > 1:
+        log.debug(f"Fetching {len(missing)} member(s) of {main_account_id} missing from the system list")
+    for pk_member_id, pk_member in zip(
+        missing, await asyncio.gather(*[pk_get_member(m, max_age=max_age) for m in missing])
+    ):
+        found[pk_member_id] = pk_member
+    return found, calls + len(missing)
+
+
 # TODO: 3 strike system for auto-suspend
 async def sync(
     ctx: commands.context,
-    query: List[sqlite3.Row],
+    query: List[dict],
     message=":hourglass: Syncing Members",
+    max_age: Optional[float] = None,
 ) -> NoReturn:
-    async def sync_helper(i: int, total: int, member, logger):
+    """
+    Sync instances with their PluralKit members
+
+    :param ctx: Discord Context
+    :param query: Member rows to sync
+    :param message: Title of the sync log message
+    :param max_age: Maximum acceptable age of cached PluralKit data in seconds. 0 always revalidates with PluralKit.
+    """
+    async def sync_helper(i: int, total: int, member, logger) -> Optional[float]:
+        # Only waits for the member's own system, so logins of fetched systems overlap with the remaining fetches
+        pk_members, _ = await asyncio.shield(pk_fetches[member["main_account_id"]])
+        pk_member = pk_members.get(member["pk_member_id"])
+        if pk_member is None:
+            await logger.edit(
+                i, f":x: Failed to sync <@{member['id']}> from PluralKit"
+            )
+            log.debug(f"Failed to sync {member['id']}")
+            return 0.0
+
+        # Compare PluralKit with what was last applied to the instance
+        state = await get_sync_state(member["id"]) or {}
+        name = pk_member.get("name")
+        avatar_url = pk_member.get("avatar_url")
+        nickname = member["nickname"] if member["nickname"] is not None else (
+            pk_member.get("display_name") or name
+        )
+        roles = default_roles_state()
+        update_username = name is not None and state.get("username") != name
+        update_avatar = avatar_url is not None and state.get("avatar_url") != avatar_url
+        update_nickname = state.get("nickname") != nickname
+        update_roles = state.get("roles") != roles
+
+        # Database writes
+        member_values = {}
+        # Tags are hidden from PluralKit's API by privacy settings, so None keeps the current tags
+        if pk_member.get("proxy_tags") is not None:
+            proxy_tags = normalize_proxy_tags(pk_member["proxy_tags"])
+            if member["proxy_tags"] != proxy_tags:
+                member_values["proxy_tags"] = proxy_tags
+        display_name = pk_member.get("display_name") if member["nickname"] is None else name
+        if display_name is not None and member["display_name"] != display_name:
+            member_values["display_name"] = display_name
+        if avatar_url is not None and member["pk_avatar_url"] != avatar_url:
+            member_values["pk_avatar_url"] = avatar_url
+        if member_values:
+            update_member(member["id"], **member_values)
+
+        if not (update_username or update_avatar or update_nickname or update_roles):
+            await logger.edit(i, f":white_check_mark: <@{member['id']}> is up to date")
+            log.debug(f"{member['id']} is up to date")
+            return 0.0
+
         # Create instance
         instance = PolyphonyInstance(member["pk_member_id"])
-        from polyphony.bot import bot
-
-        asyncio.run_coroutine_threadsafe(instance.start(member["token"]), bot.loop)
 
+        login_start = time.monotonic()
         try:
-            await asyncio.wait_for(instance.wait_until_ready(), timeout=10)
-        except asyncio.TimeoutError:
-            log.debug(f"Failed to sync {member['id']} due to timeout")
+            await asyncio.wait_for(instance.login_rest(member["token"]), timeout=10)
+        except discord.LoginFailure:
+            log.debug(f"Failed to sync {member['id']} due to invalid token")
             await instance.close()
             await logger.edit(
                 i,
-                f":x: Failed to sync <@{member['id']}> because Discord bot login timed out. The bot token was likely reset. Please contact a moderator for assistance."
+                f":x: Failed to sync <@{member['id']}> because Discord bot login failed. The bot token was likely reset. Please contact a moderator for assistance."
             )
-            return
-
-        log.debug(f"Syncing {instance.user} ({i + 1}/{total})")
-
-        # Pull from PluralKit
-        pk_member = await pk_get_member(member["pk_member_id"])
-        if pk_member is None:
+            # Discord answered, so a reset token doesn't slow down the other syncs
+            return 0.0
+        except (asyncio.TimeoutError, discord.HTTPException) as e:
+            log.debug(f"Failed to sync {member['id']} due to Discord error ({e!r})")
+            await instance.close()
             await logger.edit(
-                i, f":x: Failed to sync {instance.user.mention} from PluralKit"
+                i,
+                f":x: Failed to sync <@{member['id']}> because Discord could not be reached. Please try again later."
             )
-            log.debug(f"Failed to sync {instance.user}")
-            await instance.close()
-            return
+            return None
+        login_seconds = time.monotonic() - login_start
 
-        await instance.wait_until_ready()
+        log.debug(f"Syncing {instance.user} ({i + 1}/{total})")
 
         error_text = ""
-
-        # Update Proxy Tags
-        conn.execute(
-            "UPDATE members SET pk_proxy_tags = ? WHERE pk_member_id = ?",
-            [json.dumps(pk_member.get("proxy_tags")), member["pk_member_id"]],
-        )
+        applied = {}
 
         # Update Username
-        if (
-                instance.user.display_name != pk_member.get("name")
-                and pk_member.get("name") is not None
-        ):
+        if update_username:
             await logger.edit(
                 i,
                 f":hourglass: Syncing {instance.user.mention} Username...",
             )
-            conn.execute(
-                "UPDATE members SET display_name = ? WHERE pk_member_id = ?",
-                [pk_member.get("name"), member["pk_member_id"]],
-            )
-            out = await instance.update_username(pk_member.get("name"))
+            out = await instance.update_username(name)
             if out != 0:
                 error_text += f"> {out}\n"
+            # Also counts as applied if underscores had to be appended
+            if instance.username_applied(name):
+                applied["username"] = name
 
-        # Update Avatar URL
-        if pk_member.get("avatar_url") is not None:
+        # Update Avatar
+        if update_avatar:
             await logger.edit(
                 i,
                 f":hourglass: Syncing {instance.user.mention} Avatar...",
             )
-            conn.execute(
-                "UPDATE members SET pk_avatar_url = ? WHERE pk_member_id = ?",
-                [pk_member.get("avatar_url"), member["pk_member_id"]],
-            )
-            out = await instance.update_avatar(pk_member.get("avatar_url"))
+            out = await instance.update_avatar(avatar_url, applied_digest=state.get("avatar_digest"))
             if out != 0:
                 error_text += f"> {out}\n"
+            else:
+                applied["avatar_url"] = avatar_url
+                applied["avatar_digest"] = instance.avatar_digest
 
         # Update Nickname
-        # Check if nickname is set
-        await logger.edit(
-            i,
-            f":hourglass: Syncing {instance.user.mention} Nickname...",
-        )
-        if member["nickname"] != None:
-            out = await instance.update_nickname(member["nickname"])
-            if out < 0:
-                error_text += f"> Nickname must be 32 characters or fewer in length\n"
-            elif out > 0:
-                error_text += f"> Nick didn't update on {out} guild(s)\n"
-        # Otherwise use display_name if it exists
-        else:
-            conn.execute(
-                "UPDATE members SET display_name = ? WHERE pk_member_id = ?",
-                [pk_member.get("display_name"), member["pk_member_id"]],
-            )
-            out = await instance.update_nickname(
-                pk_member.get("display_name") or pk_member.get("name")
+        if update_nickname:
+            await logger.edit(
+                i,
+                f":hourglass: Syncing {instance.user.mention} Nickname...",
             )
+            out = await instance.update_nickname(nickname)
             if out < 0:
-                error_text += f"> PluralKit display name must be 32 characters or fewer in length if you want to use it as a nickname\n"
+                if member["nickname"] is not None:
+                    error_text += f"> Nickname must be 32 characters or fewer in length\n"
+                else:
+                    error_text += f"> PluralKit display name must be 32 characters or fewer in length if you want to use it as a nickname\n"
             elif out > 0:
                 error_text += f"> Nick didn't update on {out} guild(s)\n"
+            else:
+                applied["nickname"] = nickname
 
         # Update Roles
-        await logger.edit(
-            i,
-            f":hourglass: Syncing {instance.user.mention} Roles...",
-        )
-        out = await instance.update_default_roles()
-        if out:
-            error_text += f"> {out}\n"
+        if update_roles:
+            await logger.edit(
+                i,
+                f":hourglass: Syncing {instance.user.mention} Roles...",
+            )
+            out = await instance.update_default_roles()
+            if out:
+                error_text += f"> {out}\n"
+            else:
+                applied["roles"] = roles
+
+        if applied:
+            update_sync_state(member["id"], **applied)
 
         if error_text == "":
             await logger.edit(i, f":white_check_mark: Synced {instance.user.mention}")
@@ -136,30 +289,39 @@ async def sync(
                 i
             ] = f":warning: Synced {instance.user.mention} with errors:\n{error_text}"
 
-        conn.commit()
-
         log.debug(f"Synced {instance.user}")
 
         await instance.close()
+        return login_seconds
 
     total = len(query)
     logger = LogMessage(ctx, f'{message} ({total})')
     logger.color = discord.Color.orange()
     await logger.init()
     logger.content = [""] * total
-    sync_queue = [[]]
-    i_batch = 0
+    jobs = []
     for i, member in enumerate(query):
         logger.content[i] = f":hourglass: Syncing <@{member['id']}>..."
-        if i % SYNC_BATCH_SIZE == 0:
-            sync_queue.append([])
-            i_batch += 1
-        sync_queue[i_batch].append(sync_helper(i, total, member, logger))
+        jobs.append(functools.partial(sync_helper, i, total, member, logger))
 
     await logger.update()
 
-    for i, batch in enumerate(sync_queue):
-        log.debug(f'Syncing batch {i}')
-        await asyncio.gather(*batch)
+    # Members that are up to date are checked as soon as PluralKit responds, without logging in their instance
+    pk_fetches = {
+        main_account_id: asyncio.ensure_future(fetch_pk_system(main_account_id, pk_member_ids, max_age))
+        for main_account_id, pk_member_ids in group_by_system(query).items()
+    }
+    await SyncScheduler().run(jobs)
+
+    results = await asyncio.gather(*pk_fetches.values())
+    calls_saved = len(query) - sum(calls for _, calls in results)
+    log.debug(
+        f"Fetched {sum(len(found) for found, _ in results)} PluralKit member(s), saving {calls_saved} API call(s)"
+    )
 
-    await logger.set(":white_check_mark: Sync Complete", discord.Color.green())
\ No newline at end of file
+    await logger.set(
+        f":white_check_mark: Sync Complete ({calls_saved} PluralKit requests saved)"
+        if calls_saved > 0
+        else ":white_check_mark: Sync Complete",
+        discord.Color.green(),
+    )
\ No newline at end of file
@@ -0,0 +1,103 @@
+"""
+Precompiled proxy tag matching.
+
+Every system gets one TagMatcher holding the prefix/suffix tags of all of its enabled members.
+Matchers are built lazily and cached by main account ID until a database write invalidates the system.
+"""
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from polyphony.helpers.database import add_system_listener, get_system
+
+log = logging.getLogger(__name__)
+
+
+class _TagNode:
+    __slots__ = ("children", "tags")
+
+    def __init__(self):
+        self.children: Dict[str, _TagNode] = {}
+        self.tags: List[Tuple[str, dict]] = []  # (suffix, member) for every prefix ending here
+
+
+class TagMatcher:
+    """
+    Prefix trie with suffix checks for all proxy tags of a system.
+
+    The longest matching tag (prefix + suffix) wins. Ties go to the longer prefix and then to the member with the
+    lowest ID, so matching is deterministic regardless of the order tags were defined in on PluralKit.
+    """
+
+    def __init__(self, members: list):
+        self.members = members
+        self.root = _TagNode()
+        for member in sorted(members, key=lambda m: m["id"]):
+            for prefix, suffix in member["proxy_tags"]:
+                self.add(prefix, suffix, member)
+
+    def add(self, prefix: str, suffix: str, member):
+        # PluralKit does not allow empty tags, and one would match every message
+        if not prefix and not suffix:
+            return
+        node = self.root
+        for char in prefix:
+            node = node.children.setdefault(char, _TagNode())
+        node.tags.append((suffix, member))
+
+    def match(self, content: str) -> Optional[Tuple[dict, str, str]]:
+        """
+        Match message content in a single pass over the prefix trie
+
+        :param content: Message content
+        :return: (member, prefix, suffix) or None if no tag matches
+        """
+        best = None
+        best_length = -1
+        best_depth = -1
+        node = self.root
+        depth = 0
+        while node is not None:
+            for suffix, member in node.tags:
+                length = depth + len(suffix)
+                if (
+                    length <= len(content)
+                    and (length > best_length or (length == best_length and depth > best_depth))
+                    and content.endswith(suffix)
+                ):
+                    best = (member, content[:depth], suffix)
+                    best_length = length
+                    best_depth = depth
+            if depth >= len(content):
+                break
+            node = node.children.get(content[depth])
+            depth += 1
+        return best
+
+
+_matchers: Dict[int, TagMatcher] = {}
+
+
+def get_matcher(main_account_id: int) -> TagMatcher:
+    """
+    Get the tag matcher for a system, building it if it was invalidated
+
+    :param main_account_id: Main account ID of the system
+    """
+    matcher = _matchers.get(main_account_id)
+    if matcher is None:
+        log.debug(f"Building proxy tag matcher for {main_account_id}")
+        matcher = TagMatcher(get_system(main_account_id, enabled=True))
+        _matchers[main_account_id] = matcher
+    return matcher
+
+
+def invalidate_system(main_account_id: int):
+    """
+    Drop the cached tag matcher for a system so it is rebuilt on the next message
+
+    :param main_account_id: Main account ID of the system
+    """
+    _matchers.pop(main_account_id, None)
+
+
+add_system_listener(invalidate_system)
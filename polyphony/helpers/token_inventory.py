@@ -0,0 +1,108 @@
+"""
+Token inventory.
+
+Free tokens are kept in memory, so slot counts don't need to look at every token. Registrations take tokens through
+reservations, so two registrations running at the same time never get the same token. A reservation is committed
+(the token is marked as used) when the registration succeeds and released back to the free tokens when it fails or
+times out.
+"""
+import asyncio
+import logging
+from typing import Dict, Optional
+
+from polyphony.helpers.database import add_token_listener, count_tokens, get_token, get_tokens, update_token
+from polyphony.settings import TOKEN_RESERVATION_TIMEOUT
+
+log = logging.getLogger(__name__)
+
+
+class TokenReservation:
+    """Token taken off the free tokens until it is committed or released"""
+
+    def __init__(self, inventory: "TokenInventory", token: str, timeout: float):
+        self.inventory = inventory
+        self.token = token
+        self.active = True
+        self.expiry = asyncio.get_event_loop().call_later(timeout, self._expire)
+
+    def _finish(self) -> bool:
+        if not self.active:
+            return False
+        self.active = False
+        self.expiry.cancel()
+        self.inventory.reserved.pop(self.token, None)
+        return True
+
+    def _expire(self):
+        log.warning("Token reservation expired, releasing the token")
+        self.release()
+
+    def hold(self):
+        """Stop the reservation from expiring, it stays until it is committed or released"""
+        self.expiry.cancel()
+
+    def commit(self) -> bool:
+        """
+        Mark the token as used
+
+        :return: False if the reservation expired and the token is no longer free
+        """
+        if not self._finish():
+            if self.token not in self.inventory.free:
+                return False
+            del self.inventory.free[self.token]
+        update_token(self.token, True)
+        return True
+
+    def release(self):
+        """Give the token back unless it was committed. Does nothing if the reservation already ended."""
+        if self._finish():
+            self.inventory.token_changed(self.token)
+
+
+class TokenInventory:
+    def __init__(self):
+        self.free: Dict[str, None] = {}  # Free tokens that aren't reserved, oldest first
+        self.reserved: Dict[str, TokenReservation] = {}
+        for token in get_tokens(used=False):
+            self.free[token["token"]] = None
+        add_token_listener(self.token_changed)
+
+    def token_changed(self, token: str):
+        row = get_token(token)
+        if row is None or row["used"]:
+            self.free.pop(token, None)
+        elif token not in self.reserved:
+            self.free.setdefault(token, None)
+
+    def reserve(self, timeout: float = TOKEN_RESERVATION_TIMEOUT) -> Optional[TokenReservation]:
+        """
+        Reserve the oldest free token
+
+        :param timeout: Seconds until the token is released if the reservation wasn't committed
+        :return: Reservation or None if there are no free tokens
+        """
+        if not self.free:
+            return None
+        token = next(iter(self.free))
+        del self.free[token]
+        reservation = TokenReservation(self, token, timeout)
+        self.reserved[token] = reservation
+        return reservation
+
+    @property
+    def available(self) -> int:
+        """Number of tokens free to be reserved"""
+        return len(self.free)
+
+    def stats(self) -> dict:
+        total = count_tokens()
+        return {
+            "total": total,
+            "available": len(self.free),
+            "reserved": len(self.reserved),
+            "used": total - len(self.free) - len(self.reserved),
+        }
+
+
+token_inventory = TokenInventory()
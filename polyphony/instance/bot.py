@@ -3,15 +3,20 @@ Instances are individual bots that are created with the purpose.
 """
 import asyncio
 import logging
-from io import BytesIO
+import time
+from datetime import datetime
+from typing import List, Optional
 
+import aiohttp
 import discord
 import discord.ext
-# import imagehash
-# from PIL import Image, UnidentifiedImageError
+from discord.user import ClientUser
 
-from polyphony.helpers.database import conn
+from polyphony.helpers.avatars import AvatarTooLarge, fetch_avatar, normalize_avatar
+from polyphony.helpers.database import update_member
+from polyphony.helpers.profile_edits import defer_edit, edit_applied, edit_failed, next_edit_time, record_edit
 from polyphony.settings import (
+    AVATAR_MAX_SIZE,
     GUILD_ID,
     INSTANCE_ADD_ROLES,
     INSTANCE_REMOVE_ROLES,
@@ -19,6 +24,14 @@ from polyphony.settings import (
 
 log = logging.getLogger(__name__)
 
+# Usernames tried with appended underscores when too many users have a name
+USERNAME_ATTEMPTS = 3
+
+
+def username_candidates(name: str) -> List[str]:
+    """Usernames (without prefix) update_username tries for a name, in order"""
+    return [name + "_" * attempt for attempt in range(USERNAME_ATTEMPTS)]
+
 
 class PolyphonyInstance(discord.Client):
     """Polyphony Member Instance."""
@@ -37,8 +50,27 @@ class PolyphonyInstance(discord.Client):
         super().__init__(**options)
 
         self.pk_member_id: str = pk_member_id
+        self.rest_only: bool = False
+        self.avatar_digest: Optional[str] = None  # SHA-256 of the last avatar set by update_avatar
         log.debug(f"[INITIALIZED] ({self.pk_member_id})")
 
+    async def login_rest(self, token: str):
+        """
+        Log in without a gateway connection
+
+        Enough for profile, nickname and role updates, which only use the REST API. Guilds and members are not cached
+        in this mode.
+
+        :param token: Instance bot token
+        :raises discord.LoginFailure: The token is invalid
+        """
+        data = await self.http.static_login(token.strip(), bot=True)
+        self._connection.is_bot = True
+        self._connection.user = ClientUser(state=self._connection, data=data)
+        self.rest_only = True
+        self._ready.set()
+        log.debug(f"[REST READY] {self.user} ({self.pk_member_id})")
+
     async def on_ready(self):
         """Execute on bot initialization with the Discord API."""
         log.debug(f"[STARTUP] {self.user} ({self.pk_member_id})")
@@ -50,87 +82,96 @@ class PolyphonyInstance(discord.Client):
     async def on_disconnect(self):
         log.debug(f"[DISCONNECTED] {self.user} ({self.pk_member_id})")
 
+    def username_applied(self, name: str) -> bool:
+        """Whether the current username is one of the usernames update_username tries for `name`"""
+        return self.user.name in (f"p.{username}" for username in username_candidates(name))
+
     async def update_username(self, name):
         await self.wait_until_ready()
         log.debug(f"{self.user} ({self.pk_member_id}): Updating username")
         if len(name or "") > 32:
+            edit_failed(self.user.id, "username")
             return "Username must be 32 characters or less"
-        try:
-            await self.user.edit(username=f"p.{name}")
-            return 0
-        except discord.HTTPException as e:
-            log.info(
-                f"{self.user} ({self.pk_member_id}): Username Update Failed.\n {e.text}"
-            )
-            if "too fast" in e.text.lower():
-                return "Username is being updated too frequently"
-            elif "too many" in e.text.lower():
-                await self.update_username(f"{name}_")
-                return (
-                    f"Too many people had the username `{name}`: appended underscore(s)"
-                )
-            else:
-                return "An unknown error occurred while updating username"
+        if await next_edit_time(self.user.id, "username") > time.time():
+            due = await defer_edit(self.user.id, "username", name)
+            return f"Username update is queued until {datetime.fromtimestamp(due):%H:%M} because Discord limits how often usernames can change"
 
-    async def update_avatar(self, url, no_timeout=False):
+        out = 0
+        for username in username_candidates(name):
+            try:
+                await self.user.edit(username=f"p.{username}")
+                await record_edit(self.user.id, "username")
+                edit_applied(self.user.id, "username")
+                return out
+            except discord.HTTPException as e:
+                log.info(
+                    f"{self.user} ({self.pk_member_id}): Username Update Failed.\n {e.text}"
+                )
+                if "too fast" in e.text.lower():
+                    await record_edit(self.user.id, "username", throttled=True)
+                    due = await defer_edit(self.user.id, "username", name)
+                    return f"Username is being updated too frequently. The update is queued until {datetime.fromtimestamp(due):%H:%M}"
+                elif "too many" in e.text.lower():
+                    out = f"Too many people had the username `{name}`: appended underscore(s)"
+                else:
+                    edit_failed(self.user.id, "username")
+                    return "An unknown error occurred while updating username"
+        edit_failed(self.user.id, "username")
+        return f"Too many people have the username `{name}`"
+
+    async def update_avatar(self, url, no_timeout=False, applied_digest: Optional[str] = None):
+        """
+        :param url: Avatar image URL
+        :param no_timeout: Wait up to 5 minutes for Discord instead of 10 seconds
+        :param applied_digest: SHA-256 of the current avatar. The upload is skipped if the image is the same.
+        """
         await self.wait_until_ready()
-        import requests
 
         try:
-            # log.debug(f"{self.user} ({self.pk_member_id}): Getting Old and New Avatars")
-            avatar = requests.get(url).content
-
-            if no_timeout:
-                await asyncio.wait_for(self.user.edit(avatar=avatar), 300)
-                pass
-            else:
-                await asyncio.wait_for(self.user.edit(avatar=avatar), 10)
+            avatar, digest = await fetch_avatar(url)
+        except AvatarTooLarge:
+            edit_failed(self.user.id, "avatar")
+            return f"Avatar image is larger than {AVATAR_MAX_SIZE // (1024 * 1024)} MiB"
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            log.info(f"{self.user} ({self.pk_member_id}): Avatar download failed. \n {e!r}")
+            edit_failed(self.user.id, "avatar")
+            return "Avatar could not be downloaded"
+
+        if digest == applied_digest:
+            log.debug(f"{self.user} ({self.pk_member_id}): Skipping avatar update because the image is unchanged")
+            self.avatar_digest = digest
+            edit_applied(self.user.id, "avatar")
             return 0
 
-            # old_avatar = requests.get(self.user.avatar_url).content
-
-            # cutoff = 5
-
-            # try:
-            #     log.debug(f"{self.user} ({self.pk_member_id}): Comparing Avatar")
-            #     hash_avatar = imagehash.average_hash(Image.open(BytesIO(avatar)))
-            #     hash_old_avatar = imagehash.average_hash(
-            #         Image.open(BytesIO(old_avatar))
-            #     )
-            #     log.debug(
-            #         f"{self.user} ({self.pk_member_id}): Avatar Difference: {hash_avatar - hash_old_avatar}"
-            #     )
-            # except UnidentifiedImageError:
-            #     hash_avatar = 0
-            #     hash_old_avatar = 0
-            #     log.debug(
-            #         f"{self.user} ({self.pk_member_id}): Avatar comparison failed. Resorting to just updating"
-            #     )
-
-            # if not hash_avatar - hash_old_avatar < cutoff:
-            #     log.debug(f"{self.user} ({self.pk_member_id}): Updating Avatar")
-            #     if no_timeout:
-            #         await asyncio.wait_for(self.user.edit(avatar=avatar), 300)
-            #         pass
-            #     else:
-            #         await asyncio.wait_for(self.user.edit(avatar=avatar), 10)
-            #     return 0
-            # else:
-            #     log.debug(
-            #         f"{self.user} ({self.pk_member_id}): Skipping updating avatar because avatars are similar"
-            #     )
-            #     return 0
+        if await next_edit_time(self.user.id, "avatar") > time.time():
+            due = await defer_edit(self.user.id, "avatar", url)
+            return f"Avatar update is queued until {datetime.fromtimestamp(due):%H:%M} because Discord limits how often avatars can change"
+
+        avatar = await normalize_avatar(avatar, digest)
+
+        try:
+            log.debug(f"{self.user} ({self.pk_member_id}): Updating Avatar")
+            await asyncio.wait_for(self.user.edit(avatar=avatar), 300 if no_timeout else 10)
+            await record_edit(self.user.id, "avatar")
+            edit_applied(self.user.id, "avatar")
+            self.avatar_digest = digest
+            return 0
         except discord.HTTPException as e:
             log.info(
                 f"{self.user} ({self.pk_member_id}): Avatar Update Failed. \n {e.text}"
             )
             if "too fast" in e.text.lower():
-                return "Avatar is being updated too frequently"
+                await record_edit(self.user.id, "avatar", throttled=True)
+                due = await defer_edit(self.user.id, "avatar", url)
+                return f"Avatar is being updated too frequently. The update is queued until {datetime.fromtimestamp(due):%H:%M}"
             else:
+                edit_failed(self.user.id, "avatar")
                 return "An unknown error occurred while updating avatar"
         except asyncio.TimeoutError:
+            edit_failed(self.user.id, "avatar")
             return "Avatar not updated because Discord took too long"
         except discord.errors.InvalidArgument:
+            edit_failed(self.user.id, "avatar")
             return "Avatar image type is invalid"
 
     async def update_default_roles(self):
@@ -138,19 +179,22 @@ class PolyphonyInstance(discord.Client):
         log.debug(f"{self.user} ({self.pk_member_id}): Updating default roles")
         add_roles = []
         remove_roles = []
+        from polyphony.bot import bot
+
+        # Without a gateway connection the instance has no guild cache, so roles are looked up through the main bot
+        guild = bot.get_guild(GUILD_ID) if self.rest_only else self.get_guild(GUILD_ID)
         try:
             for role in INSTANCE_ADD_ROLES:
-                role = discord.utils.get(self.get_guild(GUILD_ID).roles, name=role)
+                role = discord.utils.get(guild.roles, name=role)
                 if role is not None:
                     add_roles.append(role)
             for role in INSTANCE_REMOVE_ROLES:
-                role = discord.utils.get(self.get_guild(GUILD_ID).roles, name=role)
+                role = discord.utils.get(guild.roles, name=role)
                 if role is not None:
                     remove_roles.append(role)
         except AttributeError as e:
             log.info(f"{self.user} ({self.pk_member_id}): Error updating roles: {e}")
             return "Failed to update default roles. Is the bot on the server?"
-        from polyphony.bot import bot
 
         if add_roles:
             await bot.get_guild(GUILD_ID).get_member(self.user.id).add_roles(*add_roles)
@@ -171,11 +215,21 @@ class PolyphonyInstance(discord.Client):
         if name is None or name == "":
             name = self.user.display_name[2:]
 
-        conn.execute(
-            "UPDATE members SET nickname = ? WHERE id == ?",
-            [name, self.user.id],
-        )
-        conn.commit()
+        update_member(self.user.id, nickname=name)
+
+        if self.rest_only:
+            for guild in await self.http.get_guilds(100):
+                try:
+                    await self.http.change_my_nickname(guild["id"], name)
+                    log.debug(
+                        f"{self.user} ({self.pk_member_id}): Updated nickname to {name} on guild {guild['name']}"
+                    )
+                except discord.HTTPException:
+                    log.debug(
+                        f"{self.user} ({self.pk_member_id}): Failed to update nickname to {name} on guild {guild['name']}"
+                    )
+                    return_value += 1
+            return return_value
 
         for guild in self.guilds:
             try:
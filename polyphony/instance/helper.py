@@ -1,16 +1,15 @@
 import asyncio
 import logging
-import re
 from datetime import datetime, timedelta
+from typing import Dict
 
+import aiohttp
 import discord
 import discord.ext
-import requests
+from discord.http import HTTPClient
 
-from polyphony.helpers.decode_token import decode_token
-from polyphony.settings import (
-    TOKEN, EMOTE_CACHE_MAX, GUILD_ID,
-)
+from polyphony.helpers.emote_cache import EMOTE_PATTERN, persistent_emotes
+from polyphony.settings import EMOTE_CACHE_MAX
 
 log = logging.getLogger(__name__)
 
@@ -23,7 +22,8 @@ class HelperInstance(discord.Client):
         **options,
     ):
         super().__init__(**options)
-        self.lock = asyncio.Lock()
+        self.sessions: Dict[str, HTTPClient] = {}  # Member token -> HTTP session with its own rate limit state
+        self.session_lock = asyncio.Lock()
         self.invisible = False
         self.emote_cache_rate_limit_timeout = datetime.now()
         log.debug(f"Helper initialized")
@@ -32,16 +32,42 @@ class HelperInstance(discord.Client):
         """Execute on bot initialization with the Discord API."""
         log.debug(f"Helper started as {self.user}")
 
+    async def close(self):
+        await self.close_sessions()
+        await super().close()
+
+    async def get_session(self, token: str) -> HTTPClient:
+        """
+        Get the HTTP session for a member token, logging in on first use
+
+        Each session keeps its own per-route rate limit state, so members never wait on each other.
+
+        :param token: Member bot token
+        """
+        session = self.sessions.get(token)
+        if session is None:
+            async with self.session_lock:
+                session = self.sessions.get(token)
+                if session is None:
+                    session = HTTPClient(loop=self.loop)
+                    await session.static_login(token, bot=True)
+                    self.sessions[token] = session
+                    log.debug(f"Helper opened session ({len(self.sessions)} open)")
+        return session
+
+    async def close_sessions(self):
+        sessions = list(self.sessions.values())
+        self.sessions.clear()
+        await asyncio.gather(*[session.close() for session in sessions])
+
     async def edit_as(self, message: discord.Message, content, token, files=None):
         await self.wait_until_ready()
-        msg = await self.get_channel(message.channel.id).fetch_message(message.id)
-        if msg is None:
+        chan = self.get_channel(message.channel.id)
+        if chan is None:
             log.debug("Helper failed to edit")
             return False
-        async with self.lock:
-            self.http.token = token
-            await msg.edit(content=content, files=files)
-            self.http.token = TOKEN
+        session = await self.get_session(token)
+        await session.edit_message(chan.id, message.id, content=content)
         if not self.invisible:
             await self.change_presence(status=discord.Status.invisible)
         return True
@@ -54,80 +80,95 @@ class HelperInstance(discord.Client):
         if chan is None:
             log.debug("Helper failed to send")
             return False
-        async with self.lock:
-            self.http.token = token
-            await chan.trigger_typing()
-
-            # TODO: remove excessive emote_cache logging after feature is thoroughly production tested
-
-            async def emote_cache_helper(ch_emote, emote_cache):
-                log.debug(ch_emote)
-                try:
-                    emote_animated = len(re.findall(r'<a', ch_emote)) > 0
-                    emote_name = re.findall(r':.+?:', ch_emote)[0][1:-1]
-                    emote_id = re.findall(r':\d+>', ch_emote)[0][1:-1]
-                    log.debug(f'Checking if {emote_id} (:{emote_name}:) is accessible without cache.')
-                    for chk_emote in emote_cache.emojis:
-                        if int(emote_id) == chk_emote.id:
-                            log.debug(log.debug(f'{emote_id} (:{emote_name}:) is accessible. Skipping...'))
-                            return False
-                    log.debug(f'Getting emote image {emote_id} (:{emote_name}:)')
-                    if emote_animated:
-                        log.debug(f'{emote_id} (:{emote_name}:) is animated')
-                        emote_image = requests.get(f'https://cdn.discordapp.com/emojis/{emote_id}.gif').content
-                    else:
-                        log.debug(f'{emote_id} (:{emote_name}:) is not animated')
-                        emote_image = requests.get(f'https://cdn.discordapp.com/emojis/{emote_id}.webp').content
-                    log.debug(f'Uploading emote {emote_id} (:{emote_name}:)')
-                    cached_emote = await emote_cache.create_custom_emoji(name=emote_name,
-                                                                         image=emote_image)
-                    log.debug(f'{emote_id} (:{emote_name}:) uploaded')
-                    return ch_emote, f'<{"a" if emote_animated else ""}:{cached_emote.name}:{cached_emote.id}>', cached_emote
-                except discord.Forbidden:
-                    log.debug('Polyphony does not have permission to upload emote cache emoji')
+        session = await self.get_session(token)
+        await session.send_typing(chan.id)
+
+        # TODO: remove excessive emote_cache logging after feature is thoroughly production tested
+
+        async def emote_cache_helper(match, emote_cache):
+            ch_emote = match.group(0)
+            emote_animated = match.group("animated") == "a"
+            emote_name = match.group("name")
+            emote_id = int(match.group("id"))
+            log.debug(f'{emote_id} (:{emote_name}:) is not accessible without cache.')
+            try:
+                cached_emote = await persistent_emotes.get(emote_cache, emote_id, emote_name, emote_animated)
+                if cached_emote is None:
                     return False
-                except discord.HTTPException as e:
-                    log.debug(f'Failed to upload emote cache emoji\n{e}')
-                    return False
-
-            # Emote cache
-            if self.emote_cache_rate_limit_timeout > datetime.now():
-                log.debug('Emote cache rate limited')
-                emote_cache = None
-            if emote_cache:
-                # TODO: Potentially allow user to turn emote cache on and off
-                log.debug('Emote cache start')
-                emotes = [*set(re.findall(r'<a?:.+?:\d+>', content))]  # Remove duplicates
-                task_list = []
-                new_emotes = []
-                for emote in emotes[0:EMOTE_CACHE_MAX]:
-                    task_list.append(emote_cache_helper(emote, emote_cache))
-
-                log.debug('Processing emote cache...')
-                try:
-                    new_emotes = await asyncio.wait_for(asyncio.gather(*task_list), timeout=3)
-                    for emote in new_emotes:
-                        if emote:
-                            content = content.replace(emote[0], emote[1])
-
-                    log.debug(f'Message after emote cache => {content}')
-                except asyncio.TimeoutError:
-                    log.debug('DEBUG WARNING: Emote cached timed out. Disabling for 1 minute.')
-                    self.emote_cache_rate_limit_timeout = datetime.now() + timedelta(minutes=1)
-
-            await chan.send(content=content, files=files, reference=reference, mention_author=mention_author)
-
-            # Delete emote cache after send
-            if emote_cache:
-                log.debug('Deleting cached emotes after message send')
-                delete_list = []
+                return ch_emote, cached_emote
+            except discord.Forbidden:
+                log.debug('Polyphony does not have permission to upload emote cache emoji')
+                return False
+            except discord.HTTPException as e:
+                log.debug(f'Failed to upload emote cache emoji\n{e}')
+                return False
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                log.debug(f'Failed to get emote image {emote_id} (:{emote_name}:)\n{e}')
+                return False
+
+        # Emote cache
+        if self.emote_cache_rate_limit_timeout > datetime.now():
+            log.debug('Emote cache rate limited')
+            emote_cache = None
+        if emote_cache:
+            # TODO: Potentially allow user to turn emote cache on and off
+            log.debug('Emote cache start')
+            emotes = {}  # Emote text -> match, without duplicates
+            for match in EMOTE_PATTERN.finditer(content):
+                if match.group(0) not in emotes and not persistent_emotes.is_available(int(match.group("id"))):
+                    emotes[match.group(0)] = match
+            task_list = []
+            new_emotes = []
+            for match in list(emotes.values())[0:EMOTE_CACHE_MAX]:
+                task_list.append(emote_cache_helper(match, emote_cache))
+
+            log.debug('Processing emote cache...')
+            try:
+                new_emotes = await asyncio.wait_for(asyncio.gather(*task_list), timeout=3)
                 for emote in new_emotes:
                     if emote:
-                        delete_list.append(emote[2].delete())
-                await asyncio.gather(*delete_list)
-                log.debug('Emote cache complete')
+                        content = content.replace(emote[0], emote[1])
+
+                log.debug(f'Message after emote cache => {content}')
+            except asyncio.TimeoutError:
+                log.debug('DEBUG WARNING: Emote cached timed out. Disabling for 1 minute.')
+                self.emote_cache_rate_limit_timeout = datetime.now() + timedelta(minutes=1)
+
+        await self.send_with_session(
+            session, chan, content, files=files, reference=reference, mention_author=mention_author
+        )
 
-            self.http.token = TOKEN
         if not self.invisible:
             await self.change_presence(status=discord.Status.invisible)
         return True
+
+    @staticmethod
+    async def send_with_session(
+        session: HTTPClient, chan, content, files=None, reference=None, mention_author=None
+    ):
+        """Send a message through a member session (mirrors discord.abc.Messageable.send)"""
+        allowed_mentions = None
+        if mention_author is not None:
+            allowed_mentions = discord.AllowedMentions().to_dict()
+            allowed_mentions["replied_user"] = bool(mention_author)
+        if reference is not None:
+            reference = reference.to_message_reference_dict()
+
+        if files:
+            try:
+                return await session.send_files(
+                    chan.id,
+                    files=files,
+                    content=content,
+                    allowed_mentions=allowed_mentions,
+                    message_reference=reference,
+                )
+            finally:
+                for f in files:
+                    f.close()
+        return await session.send_message(
+            chan.id,
+            content,
+            allowed_mentions=allowed_mentions,
+            message_reference=reference,
+        )
@@ -40,8 +40,30 @@ ADMIN_LOGS_CHANNEL_ID: int = int(os.getenv("ADMIN_LOGS_CHANNEL_ID", 0))
 # 0 to prevent accidental "None" value from API:
 DELETE_LOGS_CHANNEL_ID: int = int(os.getenv("DELETE_LOGS_CHANNEL_ID", 0))
 DELETE_LOGS_USER_ID: int = int(os.getenv("DELETE_LOGS_USER_ID", 0))
+DB_READERS: int = int(os.getenv('DB_READERS', 2))
+AUTOPROXY_FLUSH_INTERVAL: float = float(os.getenv('AUTOPROXY_FLUSH_INTERVAL', 5))
+TOKEN_RESERVATION_TIMEOUT: float = float(os.getenv('TOKEN_RESERVATION_TIMEOUT', 600))
 SYNC_BATCH_SIZE: int = int(os.getenv('SYNC_BATCH_SIZE', 5))
+SYNC_MAX_CONCURRENCY: int = int(os.getenv('SYNC_MAX_CONCURRENCY', 10))
+LOG_MESSAGE_FLUSH_INTERVAL: float = float(os.getenv('LOG_MESSAGE_FLUSH_INTERVAL', 2))
 EMOTE_CACHE_MAX: int = int(os.getenv('EMOTE_CACHE_MAX', 5))
+EMOTE_CACHE_RESERVED_SLOTS: int = int(os.getenv('EMOTE_CACHE_RESERVED_SLOTS', 5))
+EMOTE_FETCH_TIMEOUT: float = float(os.getenv('EMOTE_FETCH_TIMEOUT', 2))
+OUTBOX_MAX_SIZE: int = int(os.getenv('OUTBOX_MAX_SIZE', 50))
+OUTBOX_FULL_POLICY: str = os.getenv('OUTBOX_FULL_POLICY', 'wait')
+HTTP_POOL_SIZE: int = int(os.getenv('HTTP_POOL_SIZE', 20))
+PK_REQUEST_TIMEOUT: float = float(os.getenv('PK_REQUEST_TIMEOUT', 10))
+PK_MAX_CONCURRENCY: int = int(os.getenv('PK_MAX_CONCURRENCY', 2))
+PK_MEMBER_CACHE_TTL: float = float(os.getenv('PK_MEMBER_CACHE_TTL', 60))
+PK_SYSTEM_CACHE_TTL: float = float(os.getenv('PK_SYSTEM_CACHE_TTL', 300))
+ATTACHMENT_SPOOL_THRESHOLD: int = int(os.getenv('ATTACHMENT_SPOOL_THRESHOLD', 1024 * 1024))
+ATTACHMENT_INFLIGHT_MAX: int = int(os.getenv('ATTACHMENT_INFLIGHT_MAX', 64 * 1024 * 1024))
+ATTACHMENT_BUDGET_TIMEOUT: float = float(os.getenv('ATTACHMENT_BUDGET_TIMEOUT', 60))
+AVATAR_FETCH_TIMEOUT: float = float(os.getenv('AVATAR_FETCH_TIMEOUT', 10))
+AVATAR_MAX_SIZE: int = int(os.getenv('AVATAR_MAX_SIZE', 8 * 1024 * 1024))
+AVATAR_WORKERS: int = int(os.getenv('AVATAR_WORKERS', 1))
+AVATAR_CACHE_DIR: str = os.getenv('AVATAR_CACHE_DIR', str(Path(__file__).parent.absolute() / 'avatar_cache'))
+AVATAR_CACHE_MAX_SIZE: int = int(os.getenv('AVATAR_CACHE_MAX_SIZE', 256 * 1024 * 1024))
 
 # Debug Mode Setup
 if DEBUG is True:
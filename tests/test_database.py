@@ -0,0 +1,45 @@
+"""
+Database migration tests
+"""
+import os
+import sys
+import tempfile
+import types
+import unittest
+from pathlib import Path
+
+_tmp = tempfile.TemporaryDirectory()
+os.environ.setdefault("TOKEN", "test")
+os.environ.setdefault("GUILD_ID", "1")
+os.environ["DATABASE_URI"] = str(Path(_tmp.name) / "polyphony.db")
+
+# Importing the polyphony package starts the bot, so only its package path is registered for the helper imports
+if "polyphony" not in sys.modules:
+    _package = types.ModuleType("polyphony")
+    _package.__path__ = [str(Path(__file__).parent.parent / "polyphony")]
+    sys.modules["polyphony"] = _package
+
+from polyphony.helpers import database  # noqa: E402
+
+
+class TestMigrations(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.version = database.init_db()
+
+    @classmethod
+    def tearDownClass(cls):
+        database.close_db()
+        database.conn.close()
+        _tmp.cleanup()
+
+    def test_migrates_to_latest_version(self):
+        self.assertEqual(self.version, database.schema_version)
+        self.assertEqual(database.conn.execute("SELECT version FROM meta").fetchone()["version"], 10)
+
+    def test_hot_queries_use_indexes(self):
+        self.assertEqual(database.check_query_plans(), {})
+
+
+if __name__ == "__main__":
+    unittest.main()